@@ -1,11 +1,26 @@
 #!/usr/bin/python
 
 import traceback
+import sys
+import os
+import math
+import time
+import mmap
+import struct
+import json
+from cStringIO import StringIO
+import threading
+import weakref
+import Queue
+from collections import OrderedDict, deque
 from Tkinter import *
 from PIL import Image
 import ImageTk
-
-debug = 6
+from xform import Affine
+try:
+    import numpy
+except ImportError:
+    numpy = None            # Only needed by ProceduralImage
 
 ## Interface decisions
 ## 
@@ -52,6 +67,21 @@ debug = 6
 
 class NotYetImplemented(Exception): pass
 
+## Zoom applied per click of the scroll wheel
+ZOOM_STEP = 1.20
+
+## How often (ms) the Tk thread checks for finished prefetches
+PREFETCH_POLL_MS = 20
+
+## How long (ms) the wheel must be still before a zoom is rendered properly
+ZOOM_SETTLE_MS = 150
+
+## How long (ms) after a view tile fails to render it is tried again
+RENDER_RETRY_MS = 1000
+
+## Drawn where an asynchronous gfunc hasn't delivered anything yet
+PLACEHOLDER_COLOR = (128, 128, 128)
+
 ## Stored integer intervals (eg. xint) here are always [inclusive, exclusive)
 ## Mapnum intervals are not, because we're often mapping to 0,1 in float;
 ## they are (inclusive, inclusive).
@@ -69,6 +99,181 @@ def dbg_display_tag_and_size(tag, event):
 def dbg_print_coords(x, y):
     print "Coords: ", x, y
 
+## Instrumentation.
+##
+## While enabled, the module's Timings object (timings) keeps a record of
+## each refresh (and of each guard band fill, zoom refinement and
+## prefetch render): when it started, how long it took, how that time
+## split between the phases below, and what it counted, including the
+## hits and misses of each named ImageCache.  Phase times are exclusive;
+## time spent in a phase entered from inside another is only charged to
+## the inner one.  A record is kept by the thread that opened it, so
+## renders on prefetch threads don't land in the refresh running on the
+## Tk thread.  Records are opened and closed with timings.record(), so
+## one left by an exception is still closed (and counts "errors").
+## While disabled, each probe costs one attribute test.
+##	"lookup": finding source pixels (stored zooms, pyramid tiles)
+##	"decode": decoding compressed image data
+##	"compute": computing procedural pixels
+##	"crop": cutting pixels out of a source image
+##	"resize": resampling
+##	"photo": making or filling PhotoImages
+##	"canvas": canvas and scrollbar updates
+
+class NullPhase:
+    "Stands in for a Phase while timing is disabled."
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+class Phase:
+    def __init__(self, record, stack, name):
+        """Time a phase NAME of RECORD; STACK holds the phases of the
+        record's thread that are under way."""
+        self.record = record
+        self.stack = stack
+        self.name = name
+        self.started = None
+
+    def charge(self, now):
+        "Add the time since this phase was (re)started to the record."
+        phases = self.record["phases"]
+        phases[self.name] = phases.get(self.name, 0.0) + now - self.started
+
+    def __enter__(self):
+        now = time.time()
+        if self.stack:
+            self.stack[-1].charge(now)
+        self.stack.append(self)
+        self.started = now
+
+    def __exit__(self, *exc):
+        now = time.time()
+        self.charge(now)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].started = now
+
+class Record:
+    "Opens a Timings record on entry and closes it on exit, however left."
+    def __init__(self, timings, kind, info):
+        self.timings = timings
+        self.kind = kind
+        self.info = info
+
+    def __enter__(self):
+        self.timings.begin(self.kind, **self.info)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.timings.count("errors")
+        self.timings.end()
+
+class Timings:
+    def __init__(self, keep=1000):
+        "Create a (disabled) recorder keeping the last KEEP records."
+        self.enabled = False
+        self.log = deque(maxlen=keep)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.null_phase = NullPhase()
+
+    def enable(self, keep=None):
+        "Start recording, keeping the last KEEP records (if given)."
+        if keep is not None:
+            with self.lock:
+                self.log = deque(self.log, maxlen=keep)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.log.clear()
+
+    def begin(self, kind, **info):
+        """Open a record of KIND for this thread, holding INFO as well.
+        Any record the thread still has open is dropped."""
+        if not self.enabled:
+            return
+        record = dict(info)
+        record.update(kind=kind, start=time.time(), phases={}, counts={})
+        self.local.record = record
+        self.local.stack = []
+
+    def end(self):
+        "Close this thread's record (if it has one) and keep it."
+        record = getattr(self.local, "record", None)
+        if record is None:
+            return
+        self.local.record = None
+        record["total"] = time.time() - record["start"]
+        with self.lock:
+            self.log.append(record)
+
+    def record(self, kind, **info):
+        """Return a context manager doing begin(KIND, **INFO) on entry and
+        end() on exit (counting "errors" if left by an exception)."""
+        if not self.enabled:
+            return self.null_phase
+        return Record(self, kind, info)
+
+    def phase(self, name):
+        """Return a context manager charging the time spent inside it to
+        phase NAME of this thread's record."""
+        if not self.enabled:
+            return self.null_phase
+        record = getattr(self.local, "record", None)
+        if record is None:
+            return self.null_phase
+        return Phase(record, self.local.stack, name)
+
+    def count(self, name, n=1):
+        "Add N to the counter NAME of this thread's record."
+        if not self.enabled:
+            return
+        record = getattr(self.local, "record", None)
+        if record is not None:
+            record["counts"][name] = record["counts"].get(name, 0) + n
+
+    def records(self, kind=None):
+        "Return the kept records (of KIND, if given), oldest first."
+        with self.lock:
+            return [r for r in self.log if kind is None or r["kind"] == kind]
+
+    def summary(self):
+        """Return, for each kind of record, how many there are and their
+        mean total and phase times, and the sums of their counters."""
+        summary = {}
+        for r in self.records():
+            s = summary.setdefault(r["kind"], {"records": 0, "total": 0.0,
+                                               "phases": {}, "counts": {}})
+            s["records"] += 1
+            s["total"] += r["total"]
+            for (name, t) in r["phases"].items():
+                s["phases"][name] = s["phases"].get(name, 0.0) + t
+            for (name, n) in r["counts"].items():
+                s["counts"][name] = s["counts"].get(name, 0) + n
+        for s in summary.values():
+            s["total"] /= s["records"]
+            for name in s["phases"]:
+                s["phases"][name] /= s["records"]
+        return summary
+
+    def json(self):
+        "Return the kept records and their summary as a JSON string."
+        return json.dumps({"records": self.records(),
+                           "summary": self.summary()})
+
+    def dump(self, f):
+        "Write the kept records and their summary to the file F as JSON."
+        f.write(self.json())
+
+timings = Timings()
+
 ## Transformation functions
 
 def distance_squared(c1, c2):
@@ -76,22 +281,37 @@ def distance_squared(c1, c2):
     (dx,dy) = (c1[0] - c2[0], c1[1] - c2[1])
     return dx*dx + dy*dy
 
-def mapped_number(x, fromrange, torange):
-    assert fromrange[0] <= x <= fromrange[1], (fromrange[0], x, fromrange[1])
-    assert torange[0] <= torange[1], (torange[0], torange[1])
-    ## Need to force floating point
-    x *= 1.0
-    return (x - fromrange[0]) / (fromrange[1] - fromrange[0]) * (torange[1] - torange[0]) + torange[0]
-
 def difference(coord_a, coord_b):
     return (coord_b[0] - coord_a[0], coord_b[1] - coord_a[1])
 
+## Zooms are kept on a ladder of powers of ZOOM_STEP, indexed by
+## integer steps, and always computed afresh from the step; multiplying
+## zooms together drifts (1.2 * 1.2 / 1.2 != 1.2), and caches keyed by
+## zoom would then never see the same key twice.
+def ladder_zoom(step):
+    "Return the zoom STEP steps up (or down) the zoom ladder from 1.0."
+    return ZOOM_STEP ** step
+
+def zoom_step(zoom):
+    "Return the step of the zoom ladder nearest to ZOOM."
+    return int(round(math.log(zoom) / math.log(ZOOM_STEP)))
+
 class ImageWidget(Frame):
     def __init__(self, parent, gfunc, image_size, **kwargs):
         """Create an Image Widget which will display an image based on the
         function passed.  That function will be called with the arguments
         (zoom_factor, (xstart, xend), (ystart, yend)) and must return a
         TkInter PhotoImage object of size (xend-xstart, yend-ystart).
+        It's called once for the whole view on each refresh, unless it has
+        a true "tiled" attribute, in which case it's called for
+        view_tile_size squares of the view (and of a guard band overscan
+        pixels wide around it) instead, and only for squares newly scrolled
+        into range.
+        If gfunc has a region() method, that's used instead, with the same
+        arguments, and returns a PIL image.  It may instead return a future
+        for the image (anything with add_done_callback(), exception() and
+        result(), like a RenderFuture), in which case the tile is drawn
+        from a lower resolution or a placeholder until it arrives.
         IMAGE_SIZE describes the "base size" of the image being backed by
         gfunc.
         starting_* describes the starting window on the image.
@@ -106,14 +326,24 @@ class ImageWidget(Frame):
         starting_zoom = kwargs.get("starting_zoom", 1.0)
         starting_size = kwargs.get("starting_size", image_size)
         starting_ul = kwargs.get("starting_ul", (0,0))
+        ## The mouse callbacks below get args (x,y) in the unzoomed
+        ## coordinate system of the whole image (scroll offset included).
         ## Called when the mouse moves (without button down) in the image
-        ## args are (x,y) and are in the unzoomed coordinate system
         self.track_func = kwargs.get("mouse_tracking_function", None)
         ## Called when the user clicks the mouse in the image
         ## (button press followed by button release without dragging)
-        ## args are (x,y) and are in the unzoomed coordinate system
         self.click_func = kwargs.get("mouse_click_function", None)
         self.maxsize_callback = kwargs.get("maxsize_callback", None)
+        ## The view is drawn as squares of this many (zoomed) pixels
+        self.view_tile_size = kwargs.get("view_tile_size", 256)
+        ## Pixels beyond each edge of the view kept drawn, so small scrolls
+        ## only have to move what's already on the canvas
+        self.overscan = kwargs.get("overscan", self.view_tile_size)
+        ## Only used if gfunc has a region() method (see refresh)
+        render_cache_bytes = kwargs.get("render_cache_bytes", 64 << 20)
+        prefetch_threads = kwargs.get("prefetch_threads", 2)
+        ## Drags are applied at most this many times a second
+        max_frame_rate = kwargs.get("max_frame_rate", 60)
         
         assert len(set(kwargs.keys())
                    - set(('starting_zoom',
@@ -121,7 +351,12 @@ class ImageWidget(Frame):
                           'starting_ul',
                           'mouse_tracking_function',
                           'mouse_click_function',
-                          'maxsize_callback'))) == 0, kwargs
+                          'maxsize_callback',
+                          'view_tile_size',
+                          'overscan',
+                          'render_cache_bytes',
+                          'prefetch_threads',
+                          'max_frame_rate'))) == 0, kwargs
 
         ## XXX: See if there's anything you don't know about and if so throw an
         ## error
@@ -129,10 +364,62 @@ class ImageWidget(Frame):
         ## Base image parameters
         self.generator_func = gfunc
         self.isize = image_size
+
+        ## View tiles on the canvas: (tx, ty) -> (item id, PhotoImage),
+        ## all at canvas_tiles_zoom.  canvas_origin is the zoomed image
+        ## point currently at canvas (0, 0).
+        self.canvas_tiles = {}
+        self.canvas_tiles_zoom = None
+        self.canvas_origin = (0, 0)
+        self.overscan_pending = False
+
+        ## A gfunc with a region() method (returning a PIL image rather
+        ## than a PhotoImage) has its view tiles cached as PIL images, and
+        ## prefetched around the view on worker threads.  View tiles an
+        ## asynchronous region() is still working on are in arriving
+        ## (view tile key -> future).
+        self.tiled_source = hasattr(gfunc, "region")
+        ## Plain gfuncs draw the whole view as one canvas item, unless
+        ## they say they can be called a view tile at a time
+        self.tiled_gfunc = self.tiled_source or getattr(gfunc, "tiled", False)
         self.canvas_image_id = None
+        self.image = None
+        self.arriving = {}
+        self.view_tiles = ImageCache(render_cache_bytes, "view tiles")
+        self.photo_pool = PhotoImagePool()
+        self.prefetch_pool = (WorkerPool(prefetch_threads)
+                              if self.tiled_source and prefetch_threads
+                              else None)
+        self.prefetch_futures = {}      # view tile key -> RenderFuture
+        self.prefetch_results = Queue.Queue()
+        self.prefetch_polling = False
+        ## View tile keys whose render failed; their stand-ins stay on the
+        ## canvas until retry_failed gets them rendered
+        self.failed = set()
+        self.retry_id = None
+
+        ## Progressive zooming.  While the wheel is turning (zoom_settle_id
+        ## is pending), view tiles not yet rendered are drawn as quick
+        ## previews scaled up or down from another zoom; the canvas tiles
+        ## showing previews are listed in preview_tiles.
+        self.zoom_settle_id = None
+        self.preview_tiles = set()
+        ## Zooms view_tiles has tiles at, worked out afresh once per
+        ## refresh or overscan fill (None until needed)
+        self.cached_zooms = None
+
+        ## Overlay objects, and the canvas items of those near the view
+        ## (overlay id -> item id) at overlay_zoom.  See add_marker.
+        self.overlay = OverlayIndex()
+        self.overlay_items = {}
+        self.overlay_zoom = None
+
+        ## Called with the widget after every refresh (see Minimap)
+        self.view_callbacks = []
 
         ## Modifier of base image size for coords currently working in
-        self.zoom = starting_zoom
+        self.zoom_step = zoom_step(starting_zoom)
+        self.zoom = ladder_zoom(self.zoom_step)
 
         ## Interval of augmented (zoomed) image currently shown
         ## Note that these must be integers; these map directly to pixels
@@ -144,6 +431,11 @@ class ImageWidget(Frame):
         self.evv_dragging = False
         self.evv_dragStart = None
         self.evv_lastActiveMouse = None
+        ## Drag motion not yet applied, and the pending flush_drag call
+        self.evv_pendingDrag = None
+        self.evv_dragFlushId = None
+        self.evv_lastDragFlush = 0.0
+        self.frame_interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
 
         ## Widgets
         self.canvas = Canvas(self)
@@ -161,6 +453,7 @@ class ImageWidget(Frame):
         self.canvas.bind("<ButtonRelease-1>", self.ev_ButtonRelease_1)
         self.canvas.bind("<Leave>", self.ev_Leave)
         self.canvas.bind("<MouseWheel>", self.ev_MouseWheel)
+        self.bind("<Destroy>", self.ev_Destroy, "+")
 
         self.canvas_origin_offset = (int(self.canvas["borderwidth"])
                                      + int(self.canvas["highlightthickness"]))
@@ -182,41 +475,529 @@ class ImageWidget(Frame):
         """Bring the image in the frame and the scroll bars in line with the
         current values."""
 
-        # Delete old image (if needed) 
-        if self.canvas_image_id:
-            self.canvas.delete(self.canvas_image_id)
-        if debug > 5:
-            print "refresh: New image (x", self.zoom, ") ", (self.xint, self.yint), (self.canvas["width"], self.canvas["height"]), [self.zoom * s for s in self.isize]
-
-        scaled_isize = [self.xint[1] - self.xint[0],
-                        self.yint[1] - self.yint[0]]
-
-        # Create the image for the canvas
-        self.image = self.generator_func(self.zoom, self.xint, self.yint)
-        self.canvas_image_id = self.canvas.create_image(0, 0, anchor=N+W,
-                                                        image=self.image)
-
-        # Figure out where scroll bars should be and put them there.
+        with timings.record("refresh", zoom=self.zoom, xint=list(self.xint),
+                            yint=list(self.yint)):
+            self.cached_zooms = None
+
+            # Line the canvas tiles up with the view: start again at a new
+            # zoom, otherwise move what's there and drop what's out of range.
+            origin = (self.xint[0], self.yint[0])
+            with timings.phase("canvas"):
+                if self.canvas_tiles_zoom != self.zoom:
+                    for key in self.canvas_tiles.keys():
+                        self.drop_canvas_tile(key)
+                    self.canvas_tiles_zoom = self.zoom
+                elif origin != self.canvas_origin:
+                    for tag in ("viewtile", "overlay"):
+                        self.canvas.move(tag, self.canvas_origin[0] - origin[0],
+                                         self.canvas_origin[1] - origin[1])
+                    (xr, yr) = self.view_tile_ranges(self.zoom,
+                                                     *self.overscan_band())
+                    for key in self.canvas_tiles.keys():
+                        if key[0] not in xr or key[1] not in yr:
+                            self.drop_canvas_tile(key)
+            self.canvas_origin = origin
+
+            # Draw whatever's newly exposed now, and the guard band once idle
+            if not self.tiled_gfunc:
+                self.place_view_image()
+            else:
+                self.place_canvas_tiles(self.xint, self.yint)
+                if self.overscan and not self.overscan_pending:
+                    self.overscan_pending = True
+                    self.after_idle(self.fill_overscan)
+
+            # Figure out where scroll bars should be and put them there.
+            with timings.phase("canvas"):
+                self.update_overlay()
+                self.update_scrollbars()
+
+            self.prefetch()
+            self.retry_failed()
+            for fn in self.view_callbacks:
+                fn(self)
+
+    def update_scrollbars(self):
+        "Show, hide and set the scroll bars to match the view."
+        ## Zoomed image pixels to scroll bar fractions
+        fraction = Affine.between((0, 0), (0, 0),
+                                  (self.isize[0] * self.zoom - 1,
+                                   self.isize[1] * self.zoom - 1), (1, 1))
+        (x0, y0, x1, y1) = fraction.rect((self.xint[0], self.yint[0],
+                                          self.xint[1] - 1, self.yint[1] - 1))
         if self.xint[0] == 0 and int(self.isize[0] * self.zoom) == self.xint[1]:
             self.hscroll.grid_remove()
         else:
             self.hscroll.grid()
-            self.hscroll.set(mapped_number(self.xint[0],
-                                           (0, self.isize[0] * self.zoom -1),
-                                           (0, 1)),
-                             mapped_number(self.xint[1] -1,
-                                           (0, self.isize[0] * self.zoom -1),
-                                           (0, 1)))
+            self.hscroll.set(x0, x1)
         if self.yint[0] == 0 and int(self.isize[1] * self.zoom) == self.yint[1]:
             self.vscroll.grid_remove()
         else:
             self.vscroll.grid()
-            self.vscroll.set(mapped_number(self.yint[0],
-                                           (0, self.isize[1] * self.zoom -1),
-                                           (0, 1)),
-                             mapped_number(self.yint[1] -1,
-                                           (0, self.isize[1] * self.zoom -1),
-                                           (0, 1)))
+            self.vscroll.set(y0, y1)
+
+    ## Coordinate frames.  Image coordinates are unzoomed image pixels
+    ## (what gfuncs' callers, the overlay and track_func/click_func deal
+    ## in), zoomed coordinates are pixels of the image at self.zoom (what
+    ## xint and yint are in), and canvas coordinates have canvas_origin
+    ## at (0, 0).
+    def zoomed_xform(self):
+        "Return the transformation from image to zoomed coordinates."
+        return Affine.scaling(self.zoom)
+
+    def canvas_xform(self):
+        "Return the transformation from image to canvas coordinates."
+        return self.zoomed_xform().then(
+            Affine.translation(-self.canvas_origin[0], -self.canvas_origin[1]))
+
+    ## View tiles.  Tile (tx, ty) at a zoom covers the zoomed pixels
+    ## [tx * view_tile_size, (tx + 1) * view_tile_size) along x (clipped
+    ## to the zoomed image), and similarly along y.
+    def view_tile_ranges(self, zoom, xint, yint):
+        """Return the ranges of view tile indices along x and y that cover
+        XINT x YINT at ZOOM."""
+        T = self.view_tile_size
+        zsize = (int(self.isize[0] * zoom), int(self.isize[1] * zoom))
+        return (range(max(0, xint[0]) // T,
+                      (min(xint[1], zsize[0]) - 1) // T + 1),
+                range(max(0, yint[0]) // T,
+                      (min(yint[1], zsize[1]) - 1) // T + 1))
+
+    def rendered_tile(self, zoom, tx, ty):
+        """Return a PIL image of view tile (TX, TY) at ZOOM from the gfunc.
+        Called from prefetch worker threads as well as the Tk thread."""
+        T = self.view_tile_size
+        zsize = (int(self.isize[0] * zoom), int(self.isize[1] * zoom))
+        return self.generator_func.region(zoom,
+                                          [tx * T, min((tx + 1) * T, zsize[0])],
+                                          [ty * T, min((ty + 1) * T, zsize[1])])
+
+    def view_tile(self, zoom, tx, ty):
+        """Return view tile (TX, TY) at ZOOM, rendering it if needed, or
+        None if an asynchronous gfunc or the prefetch pool hasn't
+        delivered it yet."""
+        key = (zoom, tx, ty)
+        t = self.view_tiles.get(key)
+        if t is None:
+            if key in self.arriving:
+                return None
+            future = self.prefetch_futures.get(key)
+            if future is not None:
+                if not future.cancel():
+                    return None         # Under way; poll_prefetch has it
+                del self.prefetch_futures[key]
+            t = self.rendered_tile(zoom, tx, ty)
+            if is_future(t):
+                self.await_tile(key, t)
+                return None
+            self.view_tiles[key] = t
+        return t
+
+    def placeholder_tile(self, tx, ty):
+        "Return a blank stand-in for view tile (TX, TY) at the current zoom."
+        T = self.view_tile_size
+        zsize = (int(self.isize[0] * self.zoom), int(self.isize[1] * self.zoom))
+        return Image.new("RGB", (min((tx + 1) * T, zsize[0]) - tx * T,
+                                 min((ty + 1) * T, zsize[1]) - ty * T),
+                         PLACEHOLDER_COLOR)
+
+    def tile_photo(self, tx, ty):
+        "Return a PhotoImage of view tile (TX, TY) at the current zoom."
+        if self.tiled_source:
+            t = None
+            if self.zoom_settle_id is not None:
+                t = self.view_tiles.peek((self.zoom, tx, ty))
+                if t is None:
+                    t = self.preview_tile(self.zoom, tx, ty)
+                    if t is not None:
+                        self.preview_tiles.add((tx, ty))
+            if t is None:
+                t = self.view_tile(self.zoom, tx, ty)
+            if t is None:
+                ## Still to arrive; stand something in for it until then
+                t = self.preview_tile(self.zoom, tx, ty)
+                if t is None:
+                    t = self.placeholder_tile(tx, ty)
+                self.preview_tiles.add((tx, ty))
+            with timings.phase("photo"):
+                return self.photo_pool.photo(t)
+        T = self.view_tile_size
+        zsize = (int(self.isize[0] * self.zoom), int(self.isize[1] * self.zoom))
+        return self.generator_func(self.zoom,
+                                   [tx * T, min((tx + 1) * T, zsize[0])],
+                                   [ty * T, min((ty + 1) * T, zsize[1])])
+
+    ## Incremental scrolling.  The canvas holds one image item (tagged
+    ## "viewtile") per view tile in the view plus a guard band of
+    ## overscan pixels around it.  A scroll moves the items; only tiles
+    ## that come into range are rendered, and tiles that leave it are
+    ## deleted.
+    def overscan_band(self):
+        "Return (xint, yint) of the view grown by the guard band."
+        return ([self.xint[0] - self.overscan, self.xint[1] + self.overscan],
+                [self.yint[0] - self.overscan, self.yint[1] + self.overscan])
+
+    def place_canvas_tiles(self, xint, yint):
+        "Make sure every view tile meeting XINT x YINT is on the canvas."
+        T = self.view_tile_size
+        (xr, yr) = self.view_tile_ranges(self.zoom, xint, yint)
+        for ty in yr:
+            for tx in xr:
+                if (tx, ty) in self.canvas_tiles:
+                    continue
+                photo = self.tile_photo(tx, ty)
+                with timings.phase("canvas"):
+                    item = self.canvas.create_image(tx * T - self.canvas_origin[0],
+                                                    ty * T - self.canvas_origin[1],
+                                                    anchor=N+W, image=photo,
+                                                    tags="viewtile")
+                self.canvas_tiles[(tx, ty)] = (item, photo)
+                timings.count("tiles drawn")
+
+    def place_view_image(self):
+        "Draw the whole view with a single call of an untiled gfunc."
+        if self.canvas_image_id:
+            self.canvas.delete(self.canvas_image_id)
+        self.image = self.generator_func(self.zoom, self.xint, self.yint)
+        with timings.phase("canvas"):
+            self.canvas_image_id = self.canvas.create_image(0, 0, anchor=N+W,
+                                                            image=self.image)
+
+    def drop_canvas_tile(self, key):
+        "Take view tile KEY off the canvas, keeping its PhotoImage for reuse."
+        (item, photo) = self.canvas_tiles.pop(key)
+        self.canvas.delete(item)
+        self.photo_pool.release(photo)
+        self.preview_tiles.discard(key)
+
+    def fill_overscan(self):
+        "Draw the guard band around the view (run when Tk is idle)."
+        self.overscan_pending = False
+        self.cached_zooms = None
+        with timings.record("overscan", zoom=self.zoom):
+            self.place_canvas_tiles(*self.overscan_band())
+            if self.overlay_items:
+                self.canvas.tag_raise("overlay")
+
+    ## Prefetching.  After each refresh the view tiles in a ring one tile
+    ## wide around the guard band, and those a one click zoom in or out around
+    ## the center of the view would need, are rendered on the prefetch
+    ## pool.  Finished tiles are handed back through prefetch_results and
+    ## moved into view_tiles from the Tk thread by poll_prefetch.
+    def prefetch_keys(self):
+        "Return the view tile keys worth having ready for the next move."
+        T = self.view_tile_size
+        keys = set()
+        (xband, yband) = self.overscan_band()
+        (xr, yr) = self.view_tile_ranges(self.zoom,
+                                         [xband[0] - T, xband[1] + T],
+                                         [yband[0] - T, yband[1] + T])
+        keys.update((self.zoom, tx, ty) for tx in xr for ty in yr)
+
+        half = ((self.xint[1] - self.xint[0]) // 2,
+                (self.yint[1] - self.yint[0]) // 2)
+        for count in (1, -1):
+            zoom = ladder_zoom(self.zoom_step + count)
+            zoomFactor = zoom / self.zoom
+            center = (int((self.xint[0] + half[0]) * zoomFactor),
+                      int((self.yint[0] + half[1]) * zoomFactor))
+            (xr, yr) = self.view_tile_ranges(zoom,
+                                             [center[0] - half[0],
+                                              center[0] + half[0]],
+                                             [center[1] - half[1],
+                                              center[1] + half[1]])
+            keys.update((zoom, tx, ty) for tx in xr for ty in yr)
+        return keys
+
+    def prefetch(self):
+        """Start rendering view tiles around the current view, and cancel
+        any not yet started that the view has moved away from.  Nothing
+        new is started while the wheel is turning."""
+        if not self.prefetch_pool or self.zoom_settle_id is not None:
+            return
+        wanted = self.prefetch_keys()
+        for futures in (self.prefetch_futures, self.arriving):
+            for (key, future) in futures.items():
+                if (key not in wanted and hasattr(future, "cancel")
+                    and future.cancel()):
+                    del futures[key]
+        for key in wanted:
+            if key not in self.view_tiles:
+                self.submit_render(key)
+
+    def submit_render(self, key):
+        "Render view tile KEY on the prefetch pool, unless already under way."
+        if key in self.prefetch_futures or key in self.arriving:
+            return
+        future = self.prefetch_pool.submit(self.prefetched_tile, *key)
+        future.add_done_callback(
+            lambda f, key=key: self.prefetch_results.put((key, f)))
+        self.prefetch_futures[key] = future
+        self.poll_prefetch_later()
+
+    def await_tile(self, key, future):
+        """Have the image FUTURE (from an asynchronous gfunc) stored as
+        view tile KEY, and drawn over its stand-in, when it arrives."""
+        self.arriving[key] = future
+        future.add_done_callback(
+            lambda f, key=key: self.prefetch_results.put((key, f)))
+        self.poll_prefetch_later()
+
+    def poll_prefetch_later(self):
+        if not self.prefetch_polling:
+            self.prefetch_polling = True
+            self.after(PREFETCH_POLL_MS, self.poll_prefetch)
+
+    def prefetched_tile(self, zoom, tx, ty):
+        "rendered_tile, timed as a prefetch (on a prefetch thread)."
+        with timings.record("prefetch", zoom=zoom, tile=(tx, ty)):
+            return self.rendered_tile(zoom, tx, ty)
+
+    def poll_prefetch(self):
+        "Move finished prefetches into view_tiles (on the Tk thread)."
+        while True:
+            try:
+                (key, future) = self.prefetch_results.get_nowait()
+            except Queue.Empty:
+                break
+            if self.prefetch_futures.get(key) is future:
+                del self.prefetch_futures[key]
+            elif self.arriving.get(key) is future:
+                del self.arriving[key]
+            if future.exception() is not None:
+                self.render_failed(key, future)
+                continue
+            t = future.result()
+            if is_future(t):
+                ## An asynchronous gfunc called from a prefetch thread
+                self.await_tile(key, t)
+                continue
+            self.failed.discard(key)
+            self.view_tiles[key] = t
+            self.replace_preview(key, t)
+        if self.prefetch_futures or self.arriving:
+            self.after(PREFETCH_POLL_MS, self.poll_prefetch)
+        else:
+            self.prefetch_polling = False
+
+    def render_failed(self, key, future):
+        """Report that FUTURE, the render of view tile KEY, failed.  The
+        tile's stand-in stays on the canvas; the first failure has it
+        tried again after RENDER_RETRY_MS, and after that every refresh
+        tries it again."""
+        print >>sys.stderr, "ImageWidget: rendering view tile %r failed" % (key,)
+        exc_info = getattr(future, "exc_info", None)
+        if exc_info:
+            traceback.print_exception(*exc_info)
+        else:
+            print >>sys.stderr, repr(future.exception())
+        if key not in self.failed:
+            self.failed.add(key)
+            if self.retry_id is None:
+                self.retry_id = self.after(RENDER_RETRY_MS, self.retry_failed)
+
+    def retry_failed(self):
+        """Render again the failed view tiles whose stand-ins are still on
+        the canvas, and forget the others."""
+        if self.retry_id is not None:
+            self.after_cancel(self.retry_id)
+            self.retry_id = None
+        if self.zoom_settle_id is not None:
+            return                      # refine_zoom will see to them
+        for key in list(self.failed):
+            (zoom, tx, ty) = key
+            if (zoom != self.canvas_tiles_zoom
+                or (tx, ty) not in self.preview_tiles):
+                self.failed.discard(key)
+            elif self.prefetch_pool:
+                self.submit_render(key)
+            else:
+                t = self.view_tile(*key)
+                if t is not None:
+                    self.failed.discard(key)
+                    self.replace_preview(key, t)
+
+    ## Progressive zooming.  A wheel click draws the new zoom at once from
+    ## whatever view tiles are cached at the nearest zoom, scaled with
+    ## nearest-neighbour sampling.  Once the wheel has been still for
+    ## ZOOM_SETTLE_MS, refine_zoom has the previews rendered properly
+    ## (on the prefetch pool when there is one) and their pixels are
+    ## pasted over the previews as they arrive.
+    def preview_tile(self, zoom, tx, ty):
+        """Return a quick rendering of view tile (TX, TY) at ZOOM scaled
+        from the cached view tiles at the nearest other zoom, or None if
+        nothing useful is cached."""
+        if self.cached_zooms is None:
+            self.cached_zooms = set(key[0] for key in self.view_tiles.keys())
+        zooms = self.cached_zooms - set([zoom])
+        if not zooms:
+            return None
+        z0 = min(zooms, key=lambda z: abs(math.log(z / zoom)))
+
+        T = self.view_tile_size
+        zsize = (int(self.isize[0] * zoom), int(self.isize[1] * zoom))
+        xint = [tx * T, min((tx + 1) * T, zsize[0])]
+        yint = [ty * T, min((ty + 1) * T, zsize[1])]
+        extent = source_extent(zoom / z0, xint, yint)
+        box = source_box(extent, (int(self.isize[0] * z0),
+                                  int(self.isize[1] * z0)), 0)
+
+        ## Assemble what's cached at z0 under the tile
+        piece = None
+        (xr, yr) = self.view_tile_ranges(z0, box[::2], box[1::2])
+        with timings.phase("lookup"):
+            for sty in yr:
+                for stx in xr:
+                    t = self.view_tiles.peek((z0, stx, sty))
+                    if t is None:
+                        continue
+                    if piece is None:
+                        piece = Image.new(t.mode, (box[2] - box[0], box[3] - box[1]))
+                    piece.paste(t, (stx * T - box[0], sty * T - box[1]))
+        if piece is None:
+            return None
+        return resampled_extent(piece, box, extent,
+                                (xint[1] - xint[0], yint[1] - yint[0]),
+                                Image.NEAREST)
+
+    def settle_zoom_later(self):
+        "(Re)start the wait for the wheel to be still."
+        if self.zoom_settle_id is not None:
+            self.after_cancel(self.zoom_settle_id)
+        self.zoom_settle_id = self.after(ZOOM_SETTLE_MS, self.refine_zoom)
+
+    def refine_zoom(self):
+        "Replace the previews drawn during a wheel zoom with proper renders."
+        self.zoom_settle_id = None
+        with timings.record("refine", zoom=self.zoom):
+            for (tx, ty) in list(self.preview_tiles):
+                key = (self.zoom, tx, ty)
+                if self.prefetch_pool:
+                    self.submit_render(key)
+                else:
+                    t = self.view_tile(*key)
+                    if t is not None:
+                        self.replace_preview(key, t)
+            self.prefetch()
+
+    def replace_preview(self, key, image):
+        """Paste IMAGE, the proper rendering of view tile KEY, over the
+        preview of it on the canvas (if there is one)."""
+        (zoom, tx, ty) = key
+        if zoom != self.canvas_tiles_zoom or (tx, ty) not in self.preview_tiles:
+            return
+        self.preview_tiles.discard((tx, ty))
+        with timings.phase("photo"):
+            self.canvas_tiles[(tx, ty)][1].paste(image)
+
+    ## Overlays.  Markers and polylines are given in unzoomed image
+    ## coordinates and kept in an OverlayIndex; only those meeting the
+    ## view and its guard band have canvas items (tagged "overlay", and
+    ## kept above the view tiles).  Items move with the view tiles when
+    ## scrolling, and are made afresh at a new zoom.  Markers keep the
+    ## same size on the screen at every zoom.
+    def add_marker(self, x, y, radius=3, **options):
+        """Put a circle of RADIUS pixels at (X, Y) over the image, drawn
+        with the canvas oval OPTIONS (fill, outline, ...); return its
+        overlay id."""
+        oid = self.overlay.add("marker", (x, y), radius, options)
+        self.update_overlay()
+        return oid
+
+    def add_markers(self, points, radius=3, **options):
+        "add_marker for each (x, y) in POINTS; return their ids."
+        oids = [self.overlay.add("marker", (x, y), radius, options)
+                for (x, y) in points]
+        self.update_overlay()
+        return oids
+
+    def add_polyline(self, points, **options):
+        """Draw lines through POINTS ((x, y) pairs) over the image, with the
+        canvas line OPTIONS (fill, width, ...); return its overlay id."""
+        oid = self.overlay.add("polyline", tuple(points),
+                               options.get("width", 1), options)
+        self.update_overlay()
+        return oid
+
+    def remove_overlay(self, oid):
+        "Take the marker or polyline OID off the image."
+        self.overlay.remove(oid)
+        item = self.overlay_items.pop(oid, None)
+        if item is not None:
+            self.canvas.delete(item)
+
+    def clear_overlay(self):
+        "Take every marker and polyline off the image."
+        self.overlay = OverlayIndex(self.overlay.cell_size)
+        self.overlay_items = {}
+        self.canvas.delete("overlay")
+
+    def update_overlay(self):
+        """Make canvas items for the overlay objects meeting the view and
+        guard band, and delete those of objects that have left it."""
+        if self.overlay_zoom != self.zoom:
+            self.canvas.delete("overlay")
+            self.overlay_items = {}
+            self.overlay_zoom = self.zoom
+        if not self.overlay.objects and not self.overlay_items:
+            return
+        (xint, yint) = self.overscan_band()
+        margin = self.overlay.max_size
+        visible = self.overlay.query(self.zoomed_xform().inverse().rect(
+            (xint[0] - margin, yint[0] - margin,
+             xint[1] + margin, yint[1] + margin)))
+        for oid in self.overlay_items.keys():
+            if oid not in visible:
+                self.canvas.delete(self.overlay_items.pop(oid))
+        new = [oid for oid in visible if oid not in self.overlay_items]
+        self.overlay_items.update(zip(new, self.overlay_canvas_items(new)))
+        if self.overlay_items:
+            self.canvas.tag_raise("overlay")
+
+    def overlay_canvas_items(self, oids):
+        """Make and return the canvas items for overlay objects OIDS, mapping
+        all their points to the canvas in one go."""
+        if not oids:
+            return []
+        objects = [self.overlay.objects[oid] for oid in oids]
+        points = []
+        for (kind, coords, size, options) in objects:
+            if kind == "marker":
+                points.append(coords)
+            else:
+                points.extend(coords)
+        mapped = self.canvas_xform().points(points)
+
+        items = []
+        i = 0
+        for (kind, coords, size, options) in objects:
+            if kind == "marker":
+                (x, y) = mapped[i]
+                i += 1
+                items.append(self.canvas.create_oval(x - size, y - size,
+                                                     x + size, y + size,
+                                                     tags="overlay", **options))
+            else:
+                flat = []
+                for (x, y) in mapped[i:i + len(coords)]:
+                    flat.extend((x, y))
+                i += len(coords)
+                items.append(self.canvas.create_line(*flat, tags="overlay",
+                                                     **options))
+        return items
+
+    def stats(self):
+        "Return a dictionary of counters describing the widget's rendering."
+        return {"view_tiles": self.view_tiles.stats(),
+                "photo_pool": self.photo_pool.stats(),
+                "canvas_tiles": len(self.canvas_tiles),
+                "overlay": {"objects": len(self.overlay.objects),
+                            "items": len(self.overlay_items)},
+                "arriving": len(self.arriving)}
+
+    def add_view_callback(self, fn):
+        "Call FN with the widget each time the view changes."
+        self.view_callbacks.append(fn)
 
     def maxsize_update(self):
         self.update_idletasks()
@@ -227,24 +1008,34 @@ class ImageWidget(Frame):
                                   int(self.zoom * self.isize[1]) + diff[1])
         
 
-    ## XXX: Need to figure out and specify what coordinates arguments to the
-    ## action functions should be in.
-    ## Currently, canvas coords
+    ## Action functions take canvas coordinates (or, for move_action, a
+    ## canvas distance).
     def move_action(self, diff):
-        "Respond as appropriate to the user moving the mouse DIFF pixels (not dragging)."
+        """Respond as appropriate to the user moving the mouse DIFF pixels
+        (not dragging); track_func gets the unzoomed distance."""
         if self.track_func:
-            self.track_func(int(diff[0] / self.zoom), int(diff[1] / self.zoom))
+            (x, y) = self.zoomed_xform().inverse().point(*diff)
+            self.track_func(int(x), int(y))
+
+    def center_on(self, x, y):
+        """Scroll the view to put the image point (X, Y) (unzoomed) in its
+        center, or as near as it can be."""
+        (zx, zy) = self.zoomed_xform().point(x, y)
+        self.drag_action((int(zx) - (self.xint[0] + self.xint[1]) // 2,
+                          int(zy) - (self.yint[0] + self.yint[1]) // 2))
 
     def click_action(self, coord):
-        "Respond as appropriate to the user clicking the mouse button in coord x,y."
+        """Respond as appropriate to the user clicking the mouse button in
+        canvas coord x,y; click_func gets the point in unzoomed image
+        coordinates."""
         if self.click_func:
-            # XXX: Canvas coords need to be mapped more explicitly.
-            self.click_func(int(coord[0] / self.zoom), int(coord[1] / self.zoom))
+            (x, y) = self.canvas_xform().inverse().point(*coord)
+            self.click_func(int(x), int(y))
 
     def scrollWheel_action(self, count, location):
         "Respond as appropriate to the scroll wheel being clicked count times."
-        ## Turn into hardcoded constant
-        zoomFactor = pow(1.20, count)
+        newZoom = ladder_zoom(self.zoom_step + count)
+        zoomFactor = newZoom / self.zoom
         view_size = (self.xint[1] - self.xint[0], self.yint[1] - self.yint[0])
         # Block if it's going to be smaller than we can display
         if (self.isize[0] * self.zoom < view_size[0]
@@ -263,15 +1054,17 @@ class ImageWidget(Frame):
         xi = [loc[0] - cloc[0], loc[0] - cloc[0] + view_size[0]]
         yi = [loc[1] - cloc[1], loc[1] - cloc[1] + view_size[1]]
 
-        print xi, yi, cloc, loc, view_size, self.zoom, zoomFactor, self.isize
-        if (xi[0] < 0 or xi[1] > self.zoom * zoomFactor * self.isize[0]
-            or yi[0] < 0 or yi[1] > self.zoom * zoomFactor * self.isize[0]):
+        if (xi[0] < 0 or xi[1] > newZoom * self.isize[0]
+            or yi[0] < 0 or yi[1] > newZoom * self.isize[1]):
             # Ignore event
             return
 
-        self.zoom *= zoomFactor
+        self.zoom_step += count
+        self.zoom = newZoom
         self.xint = xi
         self.yint = yi
+        if self.tiled_source:
+            self.settle_zoom_later()
         self.refresh()
         self.maxsize_update()
 
@@ -306,6 +1099,35 @@ class ImageWidget(Frame):
         self.general_scroll_action(self.yint, self.isize[1] * self.zoom, diff[1])
         if origx != self.xint or origy != self.yint: self.refresh()
 
+    ## Motion events can arrive far faster than views can be rendered, so
+    ## drags are accumulated and applied at most once per frame rather
+    ## than once per event.
+    def pend_drag(self, diff):
+        "Accumulate a drag of DIFF pixels, to be applied by flush_drag."
+        if self.evv_pendingDrag is None:
+            self.evv_pendingDrag = diff
+        else:
+            self.evv_pendingDrag = (self.evv_pendingDrag[0] + diff[0],
+                                    self.evv_pendingDrag[1] + diff[1])
+        if self.evv_dragFlushId is None:
+            wait = self.evv_lastDragFlush + self.frame_interval - time.time()
+            if wait > 0:
+                self.evv_dragFlushId = self.after(int(wait * 1000) + 1,
+                                                  self.flush_drag)
+            else:
+                self.evv_dragFlushId = self.after_idle(self.flush_drag)
+
+    def flush_drag(self):
+        "Apply the drag accumulated by pend_drag (if any) as one drag_action."
+        if self.evv_dragFlushId is not None:
+            self.after_cancel(self.evv_dragFlushId)
+            self.evv_dragFlushId = None
+        diff = self.evv_pendingDrag
+        self.evv_pendingDrag = None
+        self.evv_lastDragFlush = time.time()
+        if diff:
+            self.drag_action(diff)
+
     ## These next two are somewhere between event handlers and actions;
     ## they're being put in the action class since they seem closer to a
     ## user intent than a mouse click.  But I wouldn't have chosen
@@ -358,20 +1180,21 @@ class ImageWidget(Frame):
         if not self.evv_buttonDown:
             ## Notify handler of new location
             if self.track_func:
-                self.track_func(int(self.canvas.canvasx(event.x) / self.zoom),
-                                int(self.canvas.canvasy(event.y) / self.zoom))
+                (x, y) = self.canvas_xform().inverse().point(
+                    self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+                self.track_func(int(x), int(y))
         else:
             if self.evv_dragging:
                 ## Already detected a drag; move since last ev_Motion event
-                self.drag_action(difference((event.x,event.y),
-                                            self.evv_lastActiveMouse))
+                self.pend_drag(difference((event.x,event.y),
+                                          self.evv_lastActiveMouse))
             else:
                 ## Need to confirm we've been pulled enough to start dragging;
                 ## we might just be in the middle of a sloppy click
                 if distance_squared(self.evv_dragStart, (event.x,event.y)) > 25:
                     # XXX: Make 25 defined constant
-                    self.drag_action(difference((event.x,event.y),
-                                                self.evv_dragStart))
+                    self.pend_drag(difference((event.x,event.y),
+                                              self.evv_dragStart))
                     self.evv_dragging = True
                 else:
                     ## Assuing we're in the middle of a sloppy click
@@ -390,6 +1213,8 @@ class ImageWidget(Frame):
             ## This was a click
             self.click_action((int(self.canvas.canvasx(event.x)),
                               int(self.canvas.canvasy(event.y))))
+        else:
+            self.flush_drag()
         self.evv_dragging = False
         self.evv_buttonDown = False
         self.evv_dragStart = None
@@ -398,6 +1223,7 @@ class ImageWidget(Frame):
 
     def ev_Leave(self, event):
         if self.evv_buttonDown:
+            self.flush_drag()
             self.evv_dragging = False
             self.evv_buttonDown = False
             self.evv_dragStart = None
@@ -405,72 +1231,1606 @@ class ImageWidget(Frame):
     def ev_MouseWheel(self, event):
         self.scrollWheel_action(event.delta, self.winfo_pointerxy())
 
+    def ev_Destroy(self, event):
+        if event.widget is not self:
+            return
+        if self.prefetch_pool:
+            self.prefetch_pool.close()
+            self.prefetch_pool = None
+        if self.retry_id is not None:
+            self.after_cancel(self.retry_id)
+            self.retry_id = None
+
     def ev_Configure(self, event):
         self.resize_action((event.width, event.height))
 
-## Room for optimization here; don't need to resize the whole image
+## Background work.
+##
+## Tk may only be touched from the thread running its main loop, so
+## work handed to a WorkerPool must stick to PIL images and plain data;
+## whoever submits it is responsible for getting the result back onto
+## the Tk thread.
+
+class RenderFuture:
+    """The eventual result of a job submitted to a WorkerPool.  Callbacks
+    added with add_done_callback are called (with the future) in the
+    thread that finishes the job."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.state = "pending"          # "running", "cancelled", "done"
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def cancel(self):
+        "Cancel the job if it hasn't started.  Return True if cancelled."
+        with self.lock:
+            if self.state == "pending":
+                self.state = "cancelled"
+            return self.state == "cancelled"
+
+    def start(self):
+        "Mark the job as running.  Return False if it was cancelled."
+        with self.lock:
+            if self.state == "cancelled":
+                return False
+            self.state = "running"
+            return True
+
+    def cancelled(self):
+        return self.state == "cancelled"
+
+    def done(self):
+        return self.state in ("cancelled", "done")
+
+    def finish(self, value=None, exc_info=None):
+        with self.lock:
+            self.value = value
+            self.exc_info = exc_info
+            self.state = "done"
+            callbacks = self.callbacks
+            self.callbacks = []
+        self.finished.set()
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        with self.lock:
+            if self.state != "done":
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self):
+        "Return the exception the job raised (None if it didn't)."
+        self.finished.wait()
+        return self.exc_info and self.exc_info[1]
+
+    def result(self):
+        "Wait for the job and return its value, raising anything it raised."
+        self.finished.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+def is_future(x):
+    "Return True if X is a future (rather than the value it'll deliver)."
+    return hasattr(x, "add_done_callback")
+
+class WorkerPool:
+    def __init__(self, nthreads):
+        "Start NTHREADS daemon threads to run submitted jobs in order."
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(nthreads):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, fn, *args):
+        "Queue FN(*ARGS) to be run; return a RenderFuture for its result."
+        future = RenderFuture()
+        self.jobs.put((future, fn, args))
+        return future
+
+    def close(self):
+        """Have the threads exit once the jobs already submitted are done.
+        Nothing may be submitted afterwards."""
+        for t in self.threads:
+            self.jobs.put(None)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (future, fn, args) = job
+            if not future.start():
+                continue
+            try:
+                future.finish(fn(*args))
+            except Exception:
+                future.finish(exc_info=sys.exc_info())
+
+## Asynchronous gfuncs.  Either of these makes a gfunc whose region()
+## returns a RenderFuture for the image asked for rather than the image
+## itself, so the Tk thread never waits on a slow source.
+
+class CallbackGfunc:
+    def __init__(self, fn):
+        """Make an asynchronous gfunc out of FN, which is called as
+        FN(zoom, xint, yint, deliver) and must see to it that
+        deliver(image) is called (from any thread) once it has the PIL
+        image of the interval, or deliver(exc_info=sys.exc_info()) if it
+        fails."""
+        self.fn = fn
+
+    def region(self, zoom, xint, yint):
+        future = RenderFuture()
+        future.start()
+        self.fn(zoom, xint, yint, future.finish)
+        return future
+
+class BackgroundGfunc:
+    def __init__(self, gfunc, nthreads=2):
+        """Make an asynchronous gfunc that runs the region() of GFUNC on
+        its own pool of NTHREADS threads, which run until close()."""
+        self.gfunc = gfunc
+        self.pool = WorkerPool(nthreads)
+
+    def region(self, zoom, xint, yint):
+        return self.pool.submit(self.gfunc.region, zoom, xint, yint)
+
+    def close(self):
+        "Stop the pool's threads (after the renders already asked for)."
+        self.pool.close()
+
+## Image caching
+
+def image_bytes(image):
+    "Return (roughly) how many bytes of memory IMAGE's pixels occupy."
+    if image.mode in ("I", "F", "RGBX", "CMYK", "RGBA", "YCbCr"):
+        per_pixel = 4
+    elif image.mode in ("1", "L", "P"):
+        per_pixel = 1
+    else:
+        per_pixel = len(image.getbands())
+    return image.size[0] * image.size[1] * per_pixel
+
+class ImageCache:
+    """A mapping from keys to PIL images that holds at most max_bytes
+    of pixel data, discarding the least recently used images to make
+    room.  Pinned keys are never discarded (but do count against the
+    budget).  hits, misses and evictions count what get() and
+    insertion have done; a cache with a name also counts its hits and
+    misses in the timings record of the thread asking.  Safe to share
+    between threads."""
+    def __init__(self, max_bytes, name=None):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.nbytes = 0
+        self.entries = OrderedDict()    # Least recently used first
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        "Return a list of the keys stored (safe while other threads store)."
+        with self.lock:
+            return self.entries.keys()
+
+    def get(self, key, default=None):
+        "Return the image stored under KEY (marking it used), or DEFAULT."
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                if self.name:
+                    timings.count(self.name + " misses")
+                return default
+            self.hits += 1
+            if self.name:
+                timings.count(self.name + " hits")
+            image = self.entries.pop(key)
+            self.entries[key] = image
+            return image
+
+    def peek(self, key):
+        """Return the image stored under KEY, or None, without counting
+        a hit or miss or marking it used."""
+        return self.entries.get(key)
+
+    def __getitem__(self, key):
+        image = self.get(key)
+        if image is None:
+            raise KeyError(key)
+        return image
+
+    def __setitem__(self, key, image):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= image_bytes(self.entries.pop(key))
+            self.entries[key] = image
+            self.nbytes += image_bytes(image)
+            self.evict(keep=key)
+
+    def pin(self, key):
+        "Never evict KEY."
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self.evict()
+
+    def evict(self, keep=None):
+        """Drop least recently used, unpinned images (other than KEEP)
+        until the cache is back within its budget."""
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.nbytes <= self.max_bytes:
+                    break
+                if key in self.pinned or key == keep:
+                    continue
+                self.nbytes -= image_bytes(self.entries.pop(key))
+                self.evictions += 1
+
+    def stats(self):
+        "Return a dictionary describing the state of the cache."
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+## Overlay index.
+##
+## An OverlayIndex files each overlay object under the cells of a grid
+## (cell_size unzoomed pixels square) that its bounding box meets; a
+## polyline is filed segment by segment, so a long diagonal line isn't
+## filed under every cell of its bounding box.  A query only looks at
+## the cells under the box asked about (or at the cells holding
+## anything, if there are fewer of those), so its cost follows what's
+## near the box rather than how much there is in all.
+
+class OverlayIndex:
+    def __init__(self, cell_size=256):
+        self.cell_size = cell_size
+        self.cells = {}         # (cx, cy) -> set of ids
+        self.objects = {}       # id -> (kind, coords, size, options)
+        self.boxes = {}         # id -> [bounding box of each piece]
+        ## The largest size (in screen pixels) of any object; queries
+        ## must be grown by this much
+        self.max_size = 0
+        self.next_id = 1
+
+    def cell_range(self, box):
+        "Return the ranges of cell indices along x and y that BOX meets."
+        C = self.cell_size
+        return (range(int(math.floor(box[0] / C)), int(math.floor(box[2] / C)) + 1),
+                range(int(math.floor(box[1] / C)), int(math.floor(box[3] / C)) + 1))
+
+    def add(self, kind, coords, size, options):
+        """File an object of KIND ("marker" at COORDS (x, y), or "polyline"
+        through the points COORDS) that's SIZE screen pixels thick, to be
+        drawn with OPTIONS; return its id."""
+        oid = self.next_id
+        self.next_id += 1
+        if kind == "marker":
+            boxes = [coords + coords]
+        else:
+            boxes = [(min(a[0], b[0]), min(a[1], b[1]),
+                      max(a[0], b[0]), max(a[1], b[1]))
+                     for (a, b) in zip(coords, coords[1:])] or [coords[0] * 2]
+        self.objects[oid] = (kind, coords, size, options)
+        self.boxes[oid] = boxes
+        self.max_size = max(self.max_size, size)
+        for box in boxes:
+            (xr, yr) = self.cell_range(box)
+            for cy in yr:
+                for cx in xr:
+                    self.cells.setdefault((cx, cy), set()).add(oid)
+        return oid
+
+    def remove(self, oid):
+        del self.objects[oid]
+        for box in self.boxes.pop(oid):
+            (xr, yr) = self.cell_range(box)
+            for cy in yr:
+                for cx in xr:
+                    cell = self.cells.get((cx, cy))
+                    if cell:
+                        cell.discard(oid)
+                        if not cell:
+                            del self.cells[(cx, cy)]
+
+    def query(self, box):
+        "Return the set of ids of the objects with a piece meeting BOX."
+        (xr, yr) = self.cell_range(box)
+        if len(xr) * len(yr) > len(self.cells):
+            cells = [ids for (key, ids) in self.cells.items()
+                     if xr[0] <= key[0] <= xr[-1] and yr[0] <= key[1] <= yr[-1]]
+        else:
+            cells = [self.cells[(cx, cy)] for cy in yr for cx in xr
+                     if (cx, cy) in self.cells]
+        found = set()
+        for ids in cells:
+            for oid in ids:
+                if oid in found:
+                    continue
+                for b in self.boxes[oid]:
+                    if (b[0] <= box[2] and box[0] <= b[2]
+                        and b[1] <= box[3] and box[1] <= b[3]):
+                        found.add(oid)
+                        break
+        return found
+
+## PhotoImage reuse.
+##
+## Creating a Tk image for every tile drawn churns both Tk and Python
+## memory while dragging.  Tiles scrolled off the canvas give their
+## PhotoImage back to the pool, and the next tile of the same mode and
+## size has its pixels pasted into it.
+
+class PhotoImagePool:
+    def __init__(self, max_free=64):
+        """Create a pool keeping up to MAX_FREE unused PhotoImages.
+        allocations counts the PhotoImages it has had to create, and
+        reuses the times it has handed an old one out again."""
+        self.max_free = max_free
+        self.free = {}          # (mode, size) -> [PhotoImage]
+        self.nfree = 0
+        self.keys = {}          # id(PhotoImage) -> (mode, size)
+        self.allocations = 0
+        self.reuses = 0
+
+    def photo(self, image):
+        "Return a PhotoImage showing the PIL IMAGE."
+        key = (image.mode, image.size)
+        free = self.free.get(key)
+        if free:
+            photo = free.pop()
+            self.nfree -= 1
+            self.reuses += 1
+            photo.paste(image)
+        else:
+            photo = ImageTk.PhotoImage(image)
+            self.allocations += 1
+            self.keys[id(photo)] = key
+        return photo
+
+    def release(self, photo):
+        """PHOTO is no longer displayed; keep it for reuse.  PhotoImages
+        that didn't come from the pool are ignored."""
+        key = self.keys.get(id(photo))
+        if key is None:
+            return
+        if self.nfree >= self.max_free:
+            del self.keys[id(photo)]
+            return
+        self.free.setdefault(key, []).append(photo)
+        self.nfree += 1
+
+    def stats(self):
+        "Return a dictionary describing the state of the pool."
+        return {"allocations": self.allocations, "reuses": self.reuses,
+                "free": self.nfree}
+
+## Rendering helpers.
+##
+## A zoomed interval maps back to a (fractional) extent of the source
+## image.  Rather than resizing the whole source to the zoom and then
+## cropping the interval out, these crop out just the box of source
+## pixels under the extent (plus a margin for the filter) and resample
+## that, so the cost follows the size of the interval.
+
+def source_extent(scale, xint, yint):
+    """Return the (float) extent of source pixels that the interval
+    XINT x YINT covers when each source pixel is SCALE pixels wide."""
+    return (xint[0] / scale, yint[0] / scale,
+            xint[1] / scale, yint[1] / scale)
+
+def source_box(extent, size, margin):
+    """Return the integer box enclosing EXTENT grown by MARGIN pixels,
+    clipped to an image of SIZE."""
+    return (max(0, int(extent[0]) - margin), max(0, int(extent[1]) - margin),
+            min(size[0], int(math.ceil(extent[2])) + margin),
+            min(size[1], int(math.ceil(extent[3])) + margin))
+
+def resampled_extent(piece, box, extent, size, resample=Image.BILINEAR):
+    """Return EXTENT resampled to SIZE, given PIECE, the image cropped out
+    at BOX (which must enclose EXTENT)."""
+    with timings.phase("resize"):
+        return piece.transform(size, Image.EXTENT,
+                               (extent[0] - box[0], extent[1] - box[1],
+                                extent[2] - box[0], extent[3] - box[1]),
+                               resample)
+
+def zoomed_region(image, zoom, xint, yint, resample=Image.BILINEAR):
+    """Return a PIL image of the interval XINT x YINT of IMAGE zoomed by
+    ZOOM, resampling only the part of IMAGE underneath the interval."""
+    size = (xint[1] - xint[0], yint[1] - yint[0])
+    if zoom == 1.0:
+        with timings.phase("crop"):
+            return image.crop((xint[0], yint[0], xint[1], yint[1]))
+
+    ## When zooming out, shrink the cropped piece by a whole factor with
+    ## an area filter first, so the final resample never has to shrink
+    ## by more than half (which would alias).
+    factor = max(1, int(1.0 / zoom))
+    rsize = (image.size[0] // factor, image.size[1] // factor)
+    extent = source_extent(zoom * factor, xint, yint)
+    box = source_box(extent, rsize, 1)
+    with timings.phase("crop"):
+        piece = image.crop(tuple(c * factor for c in box))
+    if factor > 1:
+        with timings.phase("resize"):
+            piece = piece.resize((box[2] - box[0], box[3] - box[1]),
+                                 Image.ANTIALIAS)
+    return resampled_extent(piece, box, extent, size, resample)
+
+def halved(image):
+    """Return IMAGE reduced to half its size (rounded down, but at least
+    one pixel) with a box filter: each pixel is the mean of a 2x2 block.
+    Uses NumPy when it's there."""
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert(render_mode(image.mode))
+    size = (max(1, image.size[0] // 2), max(1, image.size[1] // 2))
+    if numpy is None or min(image.size) < 2:
+        return image.resize(size, Image.ANTIALIAS)
+    (w, h) = size
+    a = numpy.asarray(image, dtype=numpy.uint16)
+    total = (a[0:2*h:2, 0:2*w:2] + a[1:2*h:2, 0:2*w:2]
+             + a[0:2*h:2, 1:2*w:2] + a[1:2*h:2, 1:2*w:2])
+    return Image.fromarray(((total + 2) >> 2).astype(numpy.uint8), image.mode)
+
 class GfuncImageWrapper:
-    def __init__(self, baseimage):
-        self.imageStore = {}
+    def __init__(self, baseimage, max_bytes=256 << 20, crop_first=True,
+                 mipmap=True):
+        """Serve BASEIMAGE.  If CROP_FIRST is true, each request is
+        rendered from just the part of the source image underneath it.
+        Otherwise the whole source image is resized to each zoom asked
+        for, and the resized copies kept for later requests at that zoom.
+        The source image for a zoom is the closest stored copy that has
+        at least that resolution without having been enlarged (which
+        may be the base image).  With CROP_FIRST, only the base image and
+        its reductions (see MIPMAP) are ever stored, so views are derived
+        from those; deriving them from nearer resized copies only happens
+        without it.
+        If MIPMAP is true, zooming out below 0.5 first stores the base
+        image halved (with halved()) as often as needed to get within a
+        factor of two of the zoom; these reductions are kept for good and
+        are what zoomed out views are rendered from.
+        Other copies are dropped least recently used first once they take
+        up more than MAX_BYTES; the base image itself is always kept."""
+        self.imageStore = ImageCache(max_bytes, "stored zooms")
         self.imageStore[1.0] = baseimage
+        self.isize = baseimage.size
+        self.imageStore.pin(1.0)
+        self.crop_first = crop_first
+        self.mipmap = mipmap
+        ## Zoom of the smallest reduction stored
+        self.reduction = 1.0
+        ## Held while reading the base image or building a resized copy
+        self.lock = threading.Lock()
+
+    def reduce_for(self, zoom):
+        """Store halvings of the base image until the smallest is no
+        more than twice ZOOM (or a single pixel across)."""
+        with self.lock:
+            while self.reduction * 0.5 >= zoom:
+                image = self.imageStore.peek(self.reduction)
+                if min(image.size) < 2:
+                    break
+                with timings.phase("resize"):
+                    image = halved(image)
+                self.reduction *= 0.5
+                self.imageStore[self.reduction] = image
+                self.imageStore.pin(self.reduction)
+
+    def source(self, zoom):
+        """Return (sz, image), the stored image to render ZOOM from and its
+        zoom: the smallest stored zoom no less than ZOOM and no more than
+        1.0."""
+        ## One hold of the lock, so another thread can't evict the image
+        ## chosen before it's fetched
+        with self.imageStore.lock:
+            candidates = [z for z in self.imageStore.entries.keys()
+                          if zoom <= z <= 1.0]
+            sz = min(candidates) if candidates else 1.0
+            return (sz, self.imageStore[sz])
+
+    def region(self, zoom, xint, yint):
+        """Return a PIL image of the interval XINT x YINT of the image
+        zoomed by ZOOM.  (ImageWidget asks for zooms from ladder_zoom,
+        so they repeat exactly.)"""
+        if self.mipmap and self.reduction * 0.5 >= zoom:
+            self.reduce_for(zoom)
+        with timings.phase("lookup"):
+            ## Crop-first never stores whole images at view zooms, so
+            ## looking for one would only count a miss every time
+            ri = None if self.crop_first else self.imageStore.get(zoom)
+            if ri is None:
+                (sz, si) = self.source(zoom)
+        if ri is None:
+            if self.crop_first:
+                with self.lock:
+                    si.load()
+                return zoomed_region(si, zoom / sz, xint, yint)
+            with self.lock:
+                ri = self.imageStore.peek(zoom)   # Built while we waited?
+                if ri is None:
+                    ssize = (int(self.isize[0] * zoom), int(self.isize[1] * zoom))
+
+                    with timings.phase("resize"):
+                        ri = si.resize(ssize, Image.BILINEAR)
+                    self.imageStore[zoom] = ri
+
+        with timings.phase("crop"):
+            return ri.crop((xint[0],yint[0],xint[1],yint[1]))
 
-    # XXX: Worth rounding zoom?
     def __call__(self, zoom, xint, yint):
-        if debug > 5:
-            print "GFunc for image: ", zoom, xint, yint
-        if zoom not in self.imageStore:
-            bi = self.imageStore[1.0]
-            bbox = bi.getbbox()
-            isize = (bbox[2] - bbox[0], bbox[3] - bbox[1])
-            ssize = (int(isize[0] * zoom), int(isize[1] * zoom))
-
-            self.imageStore[zoom] = bi.resize(ssize, Image.BILINEAR)
-
-        ri = self.imageStore[zoom]
-        ci = ri.crop((xint[0],yint[0],xint[1],yint[1]))
-        ki = ImageTk.PhotoImage(ci)
-        return ki
-        
+        region = self.region(zoom, xint, yint)
+        with timings.phase("photo"):
+            return ImageTk.PhotoImage(region)
 
 def gfunc_for_image(image, zoom, xint, yint):
-    bbox = image.getbbox()
-    isize = (bbox[2] - bbox[0], bbox[3] - bbox[1])
-    ssize = (int(isize[0] * zoom), int(isize[1] * zoom))
+    region = zoomed_region(image, zoom, xint, yint)
+    with timings.phase("photo"):
+        return ImageTk.PhotoImage(region)
 
-    if debug > 5:
-        print zoom, xint, yint, isize, ssize
-    ri = image.resize(ssize, Image.BILINEAR)
-    ci = ri.crop((xint[0],yint[0],xint[1],yint[1]))
-    ki = ImageTk.PhotoImage(ci)
-    return ki
+## Tile pyramid.
+##
+## Level 0 of the pyramid is the base image; level n is the base image
+## reduced by 2**n.  Each level is cut into tile_size x tile_size tiles
+## (smaller along the right and bottom edges) which are only built when
+## something asks for them: level 0 tiles are cropped out of the base
+## image, and level n tiles are made by halving the level n-1 region
+## underneath them.  A render at a given zoom reads from the smallest
+## level that still has at least that resolution, so it never touches
+## more than about twice the viewport along each axis, whatever the zoom
+## or the size of the base image.  Halving uses the box filter of
+## halved().
+
+def level_size(isize, level):
+    "Return the (width, height) of level LEVEL of a pyramid over ISIZE."
+    return (max(1, isize[0] >> level), max(1, isize[1] >> level))
+
+def pyramid_levels(isize, tile_size):
+    """Return how many levels a pyramid of TILE_SIZE tiles over ISIZE has;
+    the last is the first that fits in a single tile."""
+    levels = 1
+    while max(level_size(isize, levels - 1)) > tile_size:
+        levels += 1
+    return levels
+
+def render_mode(mode):
+    "Return the mode that tiles of an image in MODE are rendered in."
+    if mode in ("L", "RGB", "RGBA"):
+        return mode
+    return "RGBA" if "A" in mode else "RGB"
+
+class TilePyramid:
+    def __init__(self, baseimage, tile_size=256, max_bytes=128 << 20,
+                 tile_file=None):
+        """Create a gfunc serving BASEIMAGE out of a pyramid of
+        TILE_SIZE square tiles.  Nothing is rendered until asked for;
+        built tiles are kept in an ImageCache of MAX_BYTES, and, if
+        TILE_FILE (a TileFile) is given, stored there too and read back
+        from there in preference to being built; its tile size is used
+        whatever TILE_SIZE says.  BASEIMAGE may be None if TILE_FILE holds
+        every tile of level 0; the size and mode then come from the tile
+        file too."""
+        self.base = baseimage
+        if tile_file is not None:
+            tile_size = tile_file.tile_size
+        if baseimage is None:
+            (isize, mode) = (tile_file.isize, tile_file.mode)
+        else:
+            (isize, mode) = (baseimage.size, render_mode(baseimage.mode))
+        self.tile_size = tile_size
+        self.isize = isize
+        self.mode = mode
+        self.tiles = ImageCache(max_bytes, "pyramid tiles")
+        self.tile_file = tile_file
+        ## Held while reading the base image, which PIL may be decoding
+        self.lock = threading.Lock()
+        self.levels = pyramid_levels(self.isize, tile_size)
+
+    def level_size(self, level):
+        "Return the (width, height) of the image at LEVEL."
+        return level_size(self.isize, level)
+
+    def level_for_zoom(self, zoom):
+        """Return the highest level whose resolution is still at least
+        ZOOM (relative to the base image)."""
+        level = 0
+        while level < self.levels - 1 and zoom * (2 << level) <= 1.0:
+            level += 1
+        return level
+
+    def tile_box(self, level, tx, ty):
+        "Return the box (in LEVEL pixels) covered by tile (TX, TY)."
+        T = self.tile_size
+        lsize = self.level_size(level)
+        return (tx * T, ty * T,
+                min((tx + 1) * T, lsize[0]), min((ty + 1) * T, lsize[1]))
+
+    def tile(self, level, tx, ty):
+        """Return the tile (TX, TY) of LEVEL, building it if needed.
+        Safe to call from several threads at once."""
+        key = (level, tx, ty)
+        t = self.tiles.get(key)
+        if t is None and self.tile_file:
+            t = self.tile_file.get(level, tx, ty)
+            timings.count("tile file hits" if t is not None
+                          else "tile file misses")
+        if t is None:
+            t = self.built_tile(level, tx, ty)
+            if self.tile_file:
+                self.tile_file.put(level, tx, ty, t)
+        if key not in self.tiles:
+            self.tiles[key] = t
+        return t
+
+    def built_tile(self, level, tx, ty):
+        box = self.tile_box(level, tx, ty)
+        if level == 0 and self.base is None:
+            ## A hole in a tile file opened on its own
+            return Image.new(self.mode, (box[2] - box[0], box[3] - box[1]))
+        if level == 0:
+            with self.lock:
+                with timings.phase("crop"):
+                    t = self.base.crop(box)
+                    if t.mode != self.mode:
+                        t = t.convert(self.mode)
+                    else:
+                        t.load()
+            return t
+        ## Halve the region of the level below that this tile covers.
+        lsize = self.level_size(level - 1)
+        lower = self.level_region(level - 1,
+                                  (2 * box[0], 2 * box[1],
+                                   min(2 * box[2], lsize[0]),
+                                   min(2 * box[3], lsize[1])))
+        with timings.phase("resize"):
+            return halved(lower)
+
+    def level_region(self, level, box):
+        """Return an image of the pixels of LEVEL inside BOX, assembled
+        from the tiles it intersects.  Areas outside the level are black."""
+        T = self.tile_size
+        lsize = self.level_size(level)
+        region = Image.new(self.mode, (box[2] - box[0], box[3] - box[1]))
+        for ty in range(max(0, box[1]) // T,
+                        (min(box[3], lsize[1]) - 1) // T + 1):
+            for tx in range(max(0, box[0]) // T,
+                            (min(box[2], lsize[0]) - 1) // T + 1):
+                region.paste(self.tile(level, tx, ty),
+                             (tx * T - box[0], ty * T - box[1]))
+        return region
+
+    def region(self, zoom, xint, yint):
+        """Return a PIL image of the interval XINT x YINT of the image
+        zoomed by ZOOM."""
+        level = self.level_for_zoom(zoom)
+        ## Zoomed pixels per level pixel; in (0.5, 1] except when zooming
+        ## in past the base image.
+        scale = zoom * (1 << level)
+        if scale == 1.0:
+            with timings.phase("lookup"):
+                return self.level_region(level,
+                                         (xint[0], yint[0], xint[1], yint[1]))
+
+        extent = source_extent(scale, xint, yint)
+        box = source_box(extent, self.level_size(level), 1)
+        with timings.phase("lookup"):
+            piece = self.level_region(level, box)
+        return resampled_extent(piece, box, extent,
+                                (xint[1] - xint[0], yint[1] - yint[0]))
+
+    def overview(self, max_size):
+        """Return the whole image shrunk to fit MAX_SIZE (width, height),
+        made from the pyramid's smallest level."""
+        return fitted(self.tile(self.levels - 1, 0, 0), max_size)
+
+    def __call__(self, zoom, xint, yint):
+        region = self.region(zoom, xint, yint)
+        with timings.phase("photo"):
+            return ImageTk.PhotoImage(region)
+
+## Persistent tile files.
+##
+## A TileFile keeps the tiles of a TilePyramid on disk so that the next
+## run over the same image needn't decode or resize anything.  It's a
+## single file: a header, then an index with one byte per tile of every
+## level (non-zero once the tile has been written), then one fixed-size
+## slot per tile holding its raw pixels (edge tiles are padded out to
+## full size).  Slots are laid out level by level, row by row, so a
+## tile's place in the file follows from its coordinates.  The file is
+## memory mapped, and tiles are served straight from the mapping.  It
+## records the modification time and size of the image it was made
+## from, and is started again from scratch if those change.
+
+TileFileMagic = "IWTILES1"
+TileFileHeader = "<8sdQLLLL8sQ"   # magic, source mtime, source size,
+                                  # width, height, tile size, levels,
+                                  # mode, offset of first slot
+TileFileAlign = 4096
+
+def mode_bytes(mode):
+    "Return the bytes per pixel of raw tiles in MODE (see render_mode)."
+    return {"L": 1, "RGB": 3, "RGBA": 4}[mode]
+
+class TileFile:
+    class BadTileFile(Exception): pass
+
+    def __init__(self, path, source_path, isize, mode, tile_size=256):
+        """Open (or create) the tile file PATH for a pyramid of TILE_SIZE
+        tiles over the image SOURCE_PATH, which is ISIZE and rendered in
+        MODE.  If source_path is None, PATH must already exist and is
+        used whatever image it came from."""
+        self.path = path
+        self.isize = tuple(isize)
+        self.mode = mode
+        self.tile_size = tile_size
+        self.levels = pyramid_levels(self.isize, tile_size)
+        self.tile_bytes = tile_size * tile_size * mode_bytes(mode)
+
+        ## Slot numbers at which each level starts
+        self.level_start = [0]
+        for level in range(self.levels):
+            self.level_start.append(self.level_start[-1]
+                                    + self.level_tiles(level)[2])
+        nslots = self.level_start[-1]
+        self.index_offset = struct.calcsize(TileFileHeader)
+        self.data_offset = ((self.index_offset + nslots + TileFileAlign - 1)
+                            // TileFileAlign * TileFileAlign)
+
+        if source_path is None:
+            stamp = None
+        else:
+            st = os.stat(source_path)
+            stamp = (st.st_mtime, st.st_size)
+        if not self.matches(stamp):
+            if stamp is None:
+                raise TileFile.BadTileFile(path)
+            self.create(stamp)
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.lock = threading.Lock()
+
+    def level_tiles(self, level):
+        "Return (columns, rows, count) of the tiles in LEVEL."
+        T = self.tile_size
+        lsize = level_size(self.isize, level)
+        (cols, rows) = ((lsize[0] + T - 1) // T, (lsize[1] + T - 1) // T)
+        return (cols, rows, cols * rows)
+
+    def header(self, stamp):
+        return struct.pack(TileFileHeader, TileFileMagic, stamp[0], stamp[1],
+                           self.isize[0], self.isize[1], self.tile_size,
+                           self.levels, self.mode, self.data_offset)
+
+    def matches(self, stamp):
+        """Return True if the file at self.path is a tile file for this
+        pyramid made from a source with STAMP ((mtime, size), or None to
+        accept any source)."""
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return False
+        try:
+            data = f.read(struct.calcsize(TileFileHeader))
+            f.seek(0, 2)
+            length = f.tell()
+        finally:
+            f.close()
+        if len(data) != struct.calcsize(TileFileHeader):
+            return False
+        fields = struct.unpack(TileFileHeader, data)
+        if stamp is None:
+            stamp = fields[1:3]
+        return (data == self.header(stamp)
+                and length == self.data_offset
+                                + self.level_start[-1] * self.tile_bytes)
+
+    def create(self, stamp):
+        "Write an empty tile file (all slots absent) for a source with STAMP."
+        f = open(self.path, "wb")
+        try:
+            f.write(self.header(stamp))
+            ## Leave the index and slots as a hole; they read as zeros.
+            f.truncate(self.data_offset + self.level_start[-1] * self.tile_bytes)
+        finally:
+            f.close()
+
+    def slot(self, level, tx, ty):
+        "Return the slot number of tile (TX, TY) of LEVEL."
+        return self.level_start[level] + ty * self.level_tiles(level)[0] + tx
+
+    def has(self, level, tx, ty):
+        return self.mm[self.index_offset + self.slot(level, tx, ty)] != "\0"
+
+    def get(self, level, tx, ty):
+        "Return tile (TX, TY) of LEVEL as a PIL image, or None if not stored."
+        slot = self.slot(level, tx, ty)
+        if self.mm[self.index_offset + slot] == "\0":
+            return None
+        T = self.tile_size
+        start = self.data_offset + slot * self.tile_bytes
+        t = Image.frombuffer(self.mode, (T, T),
+                             buffer(self.mm, start, self.tile_bytes),
+                             "raw", self.mode, 0, 1)
+        lsize = level_size(self.isize, level)
+        size = (min(T, lsize[0] - tx * T), min(T, lsize[1] - ty * T))
+        if size != (T, T):
+            t = t.crop((0, 0) + size)
+        return t
+
+    def put(self, level, tx, ty, image):
+        "Store IMAGE as tile (TX, TY) of LEVEL."
+        T = self.tile_size
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        if image.size != (T, T):
+            padded = Image.new(self.mode, (T, T))
+            padded.paste(image, (0, 0))
+            image = padded
+        slot = self.slot(level, tx, ty)
+        start = self.data_offset + slot * self.tile_bytes
+        with self.lock:
+            self.mm[start:start + self.tile_bytes] = image.tobytes()
+            self.mm[self.index_offset + slot] = "\1"
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+def open_tile_file(path):
+    """Return the existing TileFile PATH, whatever image it was made from,
+    taking the pyramid's geometry from its header."""
+    f = open(path, "rb")
+    try:
+        data = f.read(struct.calcsize(TileFileHeader))
+    finally:
+        f.close()
+    if len(data) != struct.calcsize(TileFileHeader):
+        raise TileFile.BadTileFile(path)
+    fields = struct.unpack(TileFileHeader, data)
+    if fields[0] != TileFileMagic:
+        raise TileFile.BadTileFile(path)
+    return TileFile(path, None, fields[3:5], fields[7].rstrip("\0"), fields[5])
+
+## Building tile files.
+##
+## build_tile_file fills in every tile of a TileFile ahead of time using
+## a pool of processes.  Each level is split into bands (rows of tiles)
+## that are handed out to the workers; a level isn't started until the
+## one below it is finished, since its tiles are made from those.  Every
+## worker maps the same file, builds its bands with a TilePyramid over
+## it, and writes straight into the slots and index bytes of the tiles it
+## makes, which no other worker touches.
+## A source a TiffWindow can read is opened by each worker and read a
+## window at a time.  Any other source would be decoded whole by every
+## worker, so it's decoded once, before the pool is started, and kept in
+## builder_bases; the workers (forked from the building process) share
+## its pixels.
+
+## The TilePyramid each worker process builds through, by file
+builder_pyramids = {}
+## Decoded source images, by tile file (see above)
+builder_bases = {}
+
+def builder_pyramid(path, source_path, tile_size):
+    "Return this process's TilePyramid writing to the tile file PATH."
+    pyramid = builder_pyramids.get(path)
+    if pyramid is None:
+        base = builder_bases.get(path)
+        if base is None:
+            base = Image.open(source_path)
+        if base.format == "TIFF" and path not in builder_bases:
+            try:
+                base = TiffWindow(source_path)
+            except TiffWindow.Unsupported:
+                pass
+        tf = TileFile(path, None, base.size, render_mode(base.mode), tile_size)
+        ## Only the band being built and the one below it need be kept.
+        pyramid = TilePyramid(base, tile_size, 16 << 20, tf)
+        builder_pyramids[path] = pyramid
+    return pyramid
+
+def build_band(args):
+    """Build row TY of the tiles of LEVEL of the tile file PATH (a
+    worker's job); return how many tiles were built."""
+    (path, source_path, tile_size, level, ty) = args
+    pyramid = builder_pyramid(path, source_path, tile_size)
+    cols = pyramid.tile_file.level_tiles(level)[0]
+    built = 0
+    for tx in range(cols):
+        if not pyramid.tile_file.has(level, tx, ty):
+            pyramid.tile(level, tx, ty)
+            built += 1
+    return built
+
+def build_tile_file(source_path, path, tile_size=256, processes=None,
+                    report=None):
+    """Build every tile of the pyramid over the image SOURCE_PATH into the
+    tile file PATH with a pool of PROCESSES processes (one per core by
+    default).  Tiles already in the file are kept.  REPORT, if given, is
+    called with (level, tiles, seconds) as each level finishes.  Returns
+    (tiles, seconds) for the whole build."""
+    import multiprocessing
+    img = Image.open(source_path)
+    tf = TileFile(path, source_path, img.size, render_mode(img.mode),
+                  tile_size)
+    windowed = False
+    if img.format == "TIFF":
+        try:
+            TiffWindow(source_path)
+            windowed = True
+        except TiffWindow.Unsupported:
+            pass
+    if not windowed:
+        img.load()
+        builder_bases[path] = img
+    del img
+    pool = multiprocessing.Pool(processes)
+    (total, start) = (0, time.time())
+    try:
+        for level in range(tf.levels):
+            lstart = time.time()
+            bands = [(path, source_path, tile_size, level, ty)
+                     for ty in range(tf.level_tiles(level)[1])]
+            built = sum(pool.imap_unordered(build_band, bands))
+            total += built
+            if report:
+                report(level, built, time.time() - lstart)
+    finally:
+        pool.close()
+        pool.join()
+        builder_bases.pop(path, None)
+    tf.flush()
+    tf.close()
+    return (total, time.time() - start)
+
+def build_tiles_main(argv):
+    """Command line entry point for building a tile file:
+    image_widget.py --build-tiles [-j PROCESSES] [-t TILE_SIZE] IMAGE [TILES]"""
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog --build-tiles [options] IMAGE [TILES]")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="worker processes (default: one per core)")
+    parser.add_option("-t", "--tile-size", type="int", default=256,
+                      help="tile size in pixels (default: 256)")
+    (options, args) = parser.parse_args(argv)
+    if len(args) not in (1, 2):
+        parser.error("expected an image and, optionally, a tile file")
+    source_path = args[0]
+    path = args[1] if len(args) > 1 else source_path + ".tiles"
+
+    def report(level, tiles, seconds):
+        print "level %d: %d tiles in %.2fs (%.0f tiles/s)" % (
+            level, tiles, seconds, tiles / max(seconds, 1e-6))
+    (tiles, seconds) = build_tile_file(source_path, path, options.tile_size,
+                                       options.processes, report)
+    print "%s: %d tiles in %.2fs (%.0f tiles/s)" % (
+        path, tiles, seconds, tiles / max(seconds, 1e-6))
+    return 0
+
+## Windowed TIFF reading.
+##
+## PIL decodes a whole image the first time any of its pixels are
+## wanted.  TIFF files are stored as independently compressed strips
+## (runs of full-width rows) or tiles, though, so a TiffWindow only
+## decodes the strips or tiles under the box asked for.  Each one is
+## decoded by wrapping its compressed bytes up as a small single-strip
+## TIFF of its own, with the tags from the original that describe the
+## pixels, and handing that to PIL.  Decoded blocks are kept in an
+## ImageCache.
+
+TiffShort = 3
+TiffLong = 4
+TiffUndefined = 7
+TiffTypeFormats = {TiffShort: "H", TiffLong: "L", TiffUndefined: "B"}
+
+## Tags copied from the original file to each block's file, with types
+TiffPixelTags = ((258, TiffShort),      # BitsPerSample
+                 (259, TiffShort),      # Compression
+                 (262, TiffShort),      # PhotometricInterpretation
+                 (277, TiffShort),      # SamplesPerPixel
+                 (284, TiffShort),      # PlanarConfiguration
+                 (317, TiffShort),      # Predictor
+                 (320, TiffShort),      # ColorMap
+                 (338, TiffShort),      # ExtraSamples
+                 (339, TiffShort),      # SampleFormat
+                 (347, TiffUndefined),  # JPEGTables
+                 (530, TiffShort))      # YCbCrSubSampling
+
+def tiff_file(entries, data):
+    """Return the bytes of a little-endian TIFF file with a single IFD of
+    ENTRIES ((tag, type, values) sorted by tag) followed by DATA.  The
+    value of a (273, TiffLong, None) entry is filled in with DATA's offset."""
+    ifd_size = 2 + 12 * len(entries) + 4
+    extra = ""
+    extra_offset = 8 + ifd_size
+    sizes = [len(v) * struct.calcsize("<" + TiffTypeFormats[t])
+             for (tag, t, v) in entries if v is not None]
+    data_offset = extra_offset + sum((n + 1) & ~1 for n in sizes if n > 4)
+    ifd = struct.pack("<H", len(entries))
+    for (tag, t, values) in entries:
+        if values is None:
+            values = (data_offset,)
+        packed = struct.pack("<%d%s" % (len(values), TiffTypeFormats[t]),
+                             *values)
+        if len(packed) <= 4:
+            ifd += struct.pack("<HHL", tag, t, len(values)) + packed.ljust(4, "\0")
+        else:
+            ifd += struct.pack("<HHLL", tag, t, len(values),
+                               extra_offset + len(extra))
+            extra += packed + "\0" * (len(packed) & 1)
+    ifd += struct.pack("<L", 0)
+    return "II*\0" + struct.pack("<L", 8) + ifd + extra + data
+
+class TiffWindow:
+    class Unsupported(Exception): pass
+
+    def __init__(self, path, max_bytes=32 << 20):
+        """Open the TIFF file PATH for windowed reading, keeping up to
+        MAX_BYTES of decoded strips or tiles.  Raises
+        TiffWindow.Unsupported if its layout can't be read that way."""
+        self.path = path
+        im = Image.open(path)
+        if im.format != "TIFF":
+            raise TiffWindow.Unsupported("not a TIFF file")
+        self.size = im.size
+        self.mode = im.mode
+        tags = im.tag
+        if tags.get(284, (1,))[0] != 1:
+            raise TiffWindow.Unsupported("separate color planes")
+
+        if 322 in tags:
+            ## Tiled: blocks are tile_w x tile_h, row by row, padded out
+            ## at the right and bottom edges
+            self.block_size = (tags[322][0], tags[323][0])
+            offsets = tags[324]
+            counts = tags[325]
+        else:
+            ## Striped: blocks are full-width runs of RowsPerStrip rows
+            self.block_size = (self.size[0], tags.get(278, (self.size[1],))[0])
+            offsets = tags[273]
+            counts = tags[279]
+        self.block_columns = ((self.size[0] + self.block_size[0] - 1)
+                              // self.block_size[0])
+        self.blocks = zip(offsets, counts)
+        if len(self.blocks) < 2:
+            raise TiffWindow.Unsupported("only one strip")
+
+        self.pixel_tags = []
+        for (tag, t) in TiffPixelTags:
+            if tag in tags:
+                values = tags[tag]
+                if t == TiffUndefined:
+                    values = tuple(ord(c) for c in "".join(values))
+                self.pixel_tags.append((tag, t, tuple(values)))
+
+        self.decoded = ImageCache(max_bytes, "tiff blocks")
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+
+    def block_box(self, n):
+        "Return the box of the image that block N covers (clipped)."
+        (bw, bh) = self.block_size
+        (col, row) = (n % self.block_columns, n // self.block_columns)
+        return (col * bw, row * bh,
+                min((col + 1) * bw, self.size[0]),
+                min((row + 1) * bh, self.size[1]))
+
+    def block(self, n):
+        "Return block N decoded, as a PIL image the size of its box."
+        b = self.decoded.get(n)
+        if b is None:
+            (offset, count) = self.blocks[n]
+            with self.lock:
+                self.file.seek(offset)
+                data = self.file.read(count)
+            ## Tiles are always stored at full size; strips are only as
+            ## tall as the rows left.
+            box = self.block_box(n)
+            if self.block_size[0] == self.size[0]:
+                (width, rows) = (box[2] - box[0], box[3] - box[1])
+            else:
+                (width, rows) = self.block_size
+            entries = sorted(self.pixel_tags
+                             + [(256, TiffLong, (width,)),
+                                (257, TiffLong, (rows,)),
+                                (273, TiffLong, None),
+                                (278, TiffLong, (rows,)),
+                                (279, TiffLong, (count,))])
+            with timings.phase("decode"):
+                b = Image.open(StringIO(tiff_file(entries, data)))
+                b.load()
+            if b.size != (box[2] - box[0], box[3] - box[1]):
+                b = b.crop((0, 0, box[2] - box[0], box[3] - box[1]))
+            self.decoded[n] = b
+        return b
+
+    def crop(self, box):
+        """Return the pixels inside BOX as a PIL image, decoding only the
+        blocks it touches.  Areas outside the image are black."""
+        region = Image.new(self.mode, (box[2] - box[0], box[3] - box[1]))
+        (bw, bh) = self.block_size
+        for row in range(max(0, box[1]) // bh,
+                         (min(box[3], self.size[1]) - 1) // bh + 1):
+            for col in range(max(0, box[0]) // bw,
+                             (min(box[2], self.size[0]) - 1) // bw + 1):
+                n = row * self.block_columns + col
+                region.paste(self.block(n), (col * bw - box[0], row * bh - box[1]))
+        return region
+
+## Mosaics.
+##
+## A MosaicImage presents many image files, each placed at some point,
+## as one image (with the size, mode and crop of a PIL image, like a
+## TiffWindow).  Only the files under a crop are opened and decoded.
+## Up to max_open files are kept open (striped or tiled TIFFs through a
+## TiffWindow of their own, so only the parts used get decoded); other
+## files are decoded whole, and kept in an ImageCache.  Placements are
+## filed in a grid of cells the size of the largest file so a crop only
+## looks at the files near it.
+
+class MosaicImage:
+    def __init__(self, placements, mode=None, max_open=32,
+                 max_bytes=64 << 20):
+        """Make an image out of PLACEMENTS, a list of (path, (x, y)) or
+        (path, (x, y), (width, height)), each putting the image file at
+        path with its top left corner at (x, y).  Files whose size isn't
+        given have their headers read now.  The image is rendered in MODE
+        (by default the render_mode of the first file); gaps are black.
+        MAX_OPEN and MAX_BYTES bound the open files and decoded pixels
+        kept."""
+        self.placements = []
+        for placement in placements:
+            (path, (x, y)) = placement[:2]
+            if len(placement) > 2:
+                size = placement[2]
+            else:
+                size = Image.open(path).size
+            self.placements.append((path, (x, y, x + size[0], y + size[1])))
+        if mode is None:
+            mode = render_mode(Image.open(self.placements[0][0]).mode)
+        self.mode = mode
+        self.size = (max(box[2] for (path, box) in self.placements),
+                     max(box[3] for (path, box) in self.placements))
+
+        self.cell_size = max(max(box[2] - box[0], box[3] - box[1])
+                             for (path, box) in self.placements)
+        self.cells = {}         # (cx, cy) -> [index into placements]
+        for (n, (path, box)) in enumerate(self.placements):
+            for cy in range(box[1] // self.cell_size,
+                            (box[3] - 1) // self.cell_size + 1):
+                for cx in range(box[0] // self.cell_size,
+                                (box[2] - 1) // self.cell_size + 1):
+                    self.cells.setdefault((cx, cy), []).append(n)
+
+        self.max_open = max_open
+        self.open_files = OrderedDict()     # path -> TiffWindow, LRU first
+        self.decoded = ImageCache(max_bytes, "mosaic files")
+        ## Held only while looking at or changing open_files, decoded and
+        ## loading; files are opened, decoded and cropped outside it.
+        ## loading holds a lock for each file being opened, so two threads
+        ## wanting the same file don't both open it.
+        self.lock = threading.RLock()
+        self.loading = {}                   # path -> Lock
+
+    def placements_in(self, box):
+        "Return the (path, box) of each placement meeting BOX."
+        C = self.cell_size
+        found = set()
+        for cy in range(max(0, box[1]) // C, (box[3] - 1) // C + 1):
+            for cx in range(max(0, box[0]) // C, (box[2] - 1) // C + 1):
+                found.update(self.cells.get((cx, cy), ()))
+        return [self.placements[n] for n in sorted(found)
+                if (self.placements[n][1][0] < box[2]
+                    and box[0] < self.placements[n][1][2]
+                    and self.placements[n][1][1] < box[3]
+                    and box[1] < self.placements[n][1][3])]
+
+    def source(self, path):
+        """Return something to crop the file PATH from: an open TiffWindow,
+        or the whole file decoded."""
+        with self.lock:
+            window = self.open_files.pop(path, None)
+            if window is not None:
+                self.open_files[path] = window
+                return window
+            image = self.decoded.get(path)
+            if image is not None:
+                return image
+            loading = self.loading.setdefault(path, threading.Lock())
+
+        with loading:
+            ## Another thread may have got it ready while we waited
+            with self.lock:
+                window = self.open_files.get(path)
+                if window is None:
+                    window = self.decoded.peek(path)
+                if window is not None:
+                    return window
+
+            image = Image.open(path)
+            if image.format == "TIFF":
+                try:
+                    window = TiffWindow(path, 4 << 20)
+                except TiffWindow.Unsupported:
+                    pass
+            if window is None:
+                with timings.phase("decode"):
+                    image.load()
+                    if image.mode != self.mode:
+                        image = image.convert(self.mode)
+
+            with self.lock:
+                self.loading.pop(path, None)
+                if window is None:
+                    self.decoded[path] = image
+                    return image
+                ## Windows dropped here are closed once the last crop
+                ## still using one lets go of it
+                self.open_files[path] = window
+                while len(self.open_files) > self.max_open:
+                    self.open_files.popitem(last=False)
+                return window
+
+    def crop(self, box):
+        """Return the pixels of the mosaic inside BOX as a PIL image,
+        reading only the files under it."""
+        region = Image.new(self.mode, (box[2] - box[0], box[3] - box[1]))
+        for (path, pbox) in self.placements_in(box):
+            part = (max(box[0], pbox[0]) - pbox[0], max(box[1], pbox[1]) - pbox[1],
+                    min(box[2], pbox[2]) - pbox[0], min(box[3], pbox[3]) - pbox[1])
+            piece = self.source(path).crop(part)
+            if piece.mode != self.mode:
+                piece = piece.convert(self.mode)
+            region.paste(piece, (pbox[0] + part[0] - box[0],
+                                 pbox[1] + part[1] - box[1]))
+        return region
+
+def mosaic_grid(rows, cell_size=None):
+    """Return the placements for a MosaicImage laying out ROWS, a list of
+    rows (top first) of image file paths (None for a gap), in a grid of
+    CELL_SIZE (width, height) cells; by default the size of the first
+    file.  Every file is given the cell's size."""
+    if cell_size is None:
+        cell_size = Image.open([p for row in rows for p in row if p][0]).size
+    return [(path, (col * cell_size[0], row * cell_size[1]), cell_size)
+            for (row, paths) in enumerate(rows)
+            for (col, path) in enumerate(paths) if path]
+
+def IWFromMosaic(parent, placements, **kwargs):
+    """Return an ImageWidget object showing the MosaicImage of
+    PLACEMENTS (see MosaicImage and mosaic_grid) from a TilePyramid.
+    Accepts the same keyword arguments as ImageWidget."""
+    mosaic = MosaicImage(placements)
+    return ImageWidget(parent, TilePyramid(mosaic), mosaic.size, **kwargs)
+
+## Procedural images.
+##
+## A ProceduralImage computes its pixels from a function of image
+## coordinates, evaluated with NumPy over the grid of pixel centres of
+## each zoomed tile asked for, so there's no base image and no limit to
+## its size; the cost follows the pixels drawn.  Tiles are tile_size
+## squares of the zoomed image (lining up with ImageWidget's view tiles
+## when the sizes agree) and are kept in an ImageCache.  With processes
+## set, the tiles a request is missing are computed on a multiprocessing
+## pool, in which case the function must be picklable (defined at the
+## top level of a module).
+
+def evaluated_tile(fn, zoom, box):
+    """Return FN evaluated at the centres of the pixels of BOX in the
+    image zoomed by ZOOM, as an array of 8 bit pixel values."""
+    x = (numpy.arange(box[0], box[2]) + 0.5) / zoom
+    y = (numpy.arange(box[1], box[3]) + 0.5) / zoom
+    (xs, ys) = numpy.meshgrid(x, y)
+    a = numpy.asarray(fn(xs, ys))
+    if a.dtype.kind == "f":
+        a = numpy.clip(a * 255.0 + 0.5, 0, 255)
+    return a.astype(numpy.uint8)
+
+def evaluated_tile_args(args):
+    "evaluated_tile(*ARGS), for Pool.map."
+    return evaluated_tile(*args)
+
+class ProceduralImage:
+    def __init__(self, fn, size, mode="RGB", tile_size=256,
+                 max_bytes=64 << 20, processes=None):
+        """Create a gfunc for an image of SIZE whose pixels are
+        FN(x, y), for arrays x and y of (unzoomed, fractional) image
+        coordinates.  FN returns an array shaped like x for MODE "L", or
+        with a last axis of the image's bands otherwise; floats are taken
+        to run from 0 to 1, integers from 0 to 255.  Computed tiles of
+        TILE_SIZE are kept up to MAX_BYTES.  If PROCESSES is given, tiles
+        are computed on a pool of that many processes, started when first
+        needed and stopped by close()."""
+        if numpy is None:
+            raise ImportError("ProceduralImage needs NumPy")
+        self.fn = fn
+        self.size = size
+        self.mode = mode
+        self.tile_size = tile_size
+        self.tiles = ImageCache(max_bytes, "procedural tiles")
+        self.processes = processes
+        self.pool = None
+        ## Held while starting or stopping the pool
+        self.lock = threading.Lock()
+
+    def process_pool(self):
+        "Return the pool of worker processes, starting it if need be."
+        with self.lock:
+            if self.pool is None:
+                import multiprocessing
+                self.pool = multiprocessing.Pool(self.processes)
+            return self.pool
+
+    def close(self):
+        "Stop the worker processes (if any); they're restarted if needed."
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def tile_box(self, zoom, tx, ty):
+        "Return the box (in zoomed pixels) covered by tile (TX, TY) at ZOOM."
+        T = self.tile_size
+        zsize = (int(self.size[0] * zoom), int(self.size[1] * zoom))
+        return (tx * T, ty * T,
+                min((tx + 1) * T, zsize[0]), min((ty + 1) * T, zsize[1]))
+
+    def computed_tiles(self, zoom, keys):
+        "Compute the tiles (TX, TY) listed in KEYS at ZOOM; return them in order."
+        jobs = [(self.fn, zoom, self.tile_box(zoom, tx, ty)) for (tx, ty) in keys]
+        if self.processes and len(jobs) > 1:
+            arrays = self.process_pool().map(evaluated_tile_args, jobs)
+        else:
+            arrays = [evaluated_tile(*job) for job in jobs]
+        return [Image.fromarray(a, self.mode) for a in arrays]
+
+    def region(self, zoom, xint, yint):
+        """Return a PIL image of the interval XINT x YINT of the image
+        zoomed by ZOOM."""
+        T = self.tile_size
+        keys = [(tx, ty)
+                for ty in range(max(0, yint[0]) // T, (yint[1] - 1) // T + 1)
+                for tx in range(max(0, xint[0]) // T, (xint[1] - 1) // T + 1)]
+        tiles = dict((key, self.tiles.get((zoom,) + key)) for key in keys)
+        missing = [key for key in keys if tiles[key] is None]
+        if missing:
+            with timings.phase("compute"):
+                computed = self.computed_tiles(zoom, missing)
+            for (key, t) in zip(missing, computed):
+                self.tiles[(zoom,) + key] = tiles[key] = t
+        if len(keys) == 1:
+            (tx, ty) = keys[0]
+            box = (xint[0] - tx * T, yint[0] - ty * T,
+                   xint[1] - tx * T, yint[1] - ty * T)
+            if box == (0, 0) + tiles[keys[0]].size:
+                return tiles[keys[0]]
+        region = Image.new(self.mode, (xint[1] - xint[0], yint[1] - yint[0]))
+        with timings.phase("crop"):
+            for ((tx, ty), t) in tiles.items():
+                region.paste(t, (tx * T - xint[0], ty * T - yint[0]))
+        return region
+
+    def __call__(self, zoom, xint, yint):
+        region = self.region(zoom, xint, yint)
+        with timings.phase("photo"):
+            return ImageTk.PhotoImage(region)
+
+def IWFromFunction(parent, fn, size, **kwargs):
+    """Return an ImageWidget object showing the ProceduralImage of FN
+    over SIZE.  The keyword arguments mode and processes are passed on
+    to ProceduralImage (which is given the widget's view_tile_size);
+    the rest to ImageWidget.  The ProceduralImage is closed when the
+    widget is destroyed."""
+    gfunc = ProceduralImage(fn, size, kwargs.pop("mode", "RGB"),
+                            kwargs.get("view_tile_size", 256),
+                            processes=kwargs.pop("processes", None))
+    widget = ImageWidget(parent, gfunc, size, **kwargs)
+    widget.bind("<Destroy>", lambda event: gfunc.close(), "+")
+    return widget
+
+## Shared sources.
+##
+## Widgets showing the same file (an overview and a detail view, say)
+## can share one gfunc, and with it the tiles and resized copies it
+## keeps, by getting it from the module's SourceRegistry, sources;
+## IWFromFile does so when passed shared=True.  The gfuncs here are all
+## safe to use from several threads at once.  A source stays in the
+## registry only as long as something else refers to it.
+
+class SourceRegistry:
+    def __init__(self):
+        self.sources = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def source(self, key, factory):
+        """Return the source registered under KEY, calling FACTORY() to
+        make (and register) it if there isn't one."""
+        with self.lock:
+            gfunc = self.sources.get(key)
+            if gfunc is None:
+                gfunc = factory()
+                self.sources[key] = gfunc
+            return gfunc
+
+    def file_source(self, file, tiled=True, tile_cache=None):
+        """Return the shared gfunc for the image file FILE, as made by
+        file_gfunc (made afresh if the file has changed)."""
+        st = os.stat(file)
+        key = (os.path.abspath(file), st.st_mtime, st.st_size, tiled,
+               tile_cache)
+        return self.source(key, lambda: file_gfunc(file, tiled, tile_cache))
+
+sources = SourceRegistry()
+
+## Overview minimaps.
+
+def fitted(image, max_size):
+    "Return IMAGE resized to fit MAX_SIZE (width, height), keeping its shape."
+    scale = min(float(max_size[0]) / image.size[0],
+                float(max_size[1]) / image.size[1])
+    size = (max(1, int(image.size[0] * scale)),
+            max(1, int(image.size[1] * scale)))
+    if size == image.size:
+        return image
+    return image.resize(size, Image.ANTIALIAS if scale < 1 else Image.BILINEAR)
+
+class Minimap(Frame):
+    def __init__(self, parent, detail, max_size=(200, 200), **options):
+        """Create a view of the whole image shown by the ImageWidget
+        DETAIL, at most MAX_SIZE, with the part DETAIL shows outlined (the
+        outline is a canvas rectangle drawn with OPTIONS).  Clicking or
+        dragging in it moves DETAIL's view there.  The picture comes from
+        the gfunc's overview() if it has one (a TilePyramid's is its
+        smallest level), otherwise from rendering the fitting zoom, so the
+        minimap does no more work on the image than it must."""
+        Frame.__init__(self, parent)
+        self.detail = detail
+        gfunc = detail.generator_func
+        isize = detail.isize
+        zoom = min(float(max_size[0]) / isize[0], float(max_size[1]) / isize[1])
+        size = (max(1, int(isize[0] * zoom)), max(1, int(isize[1] * zoom)))
+        if hasattr(gfunc, "overview"):
+            image = gfunc.overview(max_size)
+            size = image.size
+            self.photo = ImageTk.PhotoImage(image)
+        elif hasattr(gfunc, "region"):
+            self.photo = ImageTk.PhotoImage(gfunc.region(zoom, [0, size[0]],
+                                                         [0, size[1]]))
+        else:
+            self.photo = gfunc(zoom, [0, size[0]], [0, size[1]])
+        self.scale = (float(size[0]) / isize[0], float(size[1]) / isize[1])
+
+        self.canvas = Canvas(self, width=size[0], height=size[1],
+                             borderwidth=0, highlightthickness=0)
+        self.canvas.create_image(0, 0, anchor=N+W, image=self.photo)
+        options.setdefault("outline", "red")
+        self.rect = self.canvas.create_rectangle(0, 0, 0, 0, **options)
+        self.canvas.grid(row=0, column=0)
+        self.canvas.bind("<Button-1>", self.ev_Button_1)
+        self.canvas.bind("<B1-Motion>", self.ev_Button_1)
+
+        detail.add_view_callback(self.view_changed)
+        self.view_changed(detail)
+
+    def view_changed(self, detail):
+        "Move the outline to the view DETAIL now shows."
+        view = detail.zoomed_xform().inverse().then(self.xform())
+        (x0, y0, x1, y1) = view.rect((detail.xint[0], detail.yint[0],
+                                      detail.xint[1], detail.yint[1]))
+        self.canvas.coords(self.rect, x0, y0, x1 - 1, y1 - 1)
+
+    def xform(self):
+        "Return the transformation from image to minimap coordinates."
+        return Affine.scaling(*self.scale)
+
+    def ev_Button_1(self, event):
+        self.detail.center_on(*self.xform().inverse().point(event.x, event.y))
+
+def file_gfunc(file, tiled=True, tile_cache=None):
+    """Return the gfunc IWFromFile would show the image file FILE with
+    (see there for TILED and TILE_CACHE)."""
+    img = Image.open(file)
+    if img.format == "TIFF" and tiled:
+        try:
+            img = TiffWindow(file)
+        except TiffWindow.Unsupported:
+            pass
+    tile_file = None
+    if tile_cache and tiled:
+        if tile_cache is True:
+            tile_cache = file + ".tiles"
+        tile_file = TileFile(tile_cache, file, img.size, render_mode(img.mode))
+    return image_gfunc(img, tiled, tile_file)
 
 def IWFromFile(parent, file, **kwargs):
-    "Return an ImageWidget object based on an image on a file."
-    baseimage = Image.open(file)
-    (ulx, uly, lrx, lry) = baseimage.getbbox()
-    return ImageWidget(parent,
-                       GfuncImageWrapper(baseimage),
-                       (lrx - ulx, lry - uly),
-                       **kwargs)
+    """Return an ImageWidget object based on an image on a file.
+    Accepts the same keyword arguments as IWFromImage, and also
+    tile_cache: the path of a TileFile to keep the image's tiles in
+    between runs (True means the image's path with ".tiles" added), and
+    shared: if True, the gfunc comes from the SourceRegistry sources, to
+    be shared with other widgets showing the file.
+    Striped or tiled TIFF files shown through a TilePyramid are read
+    through a TiffWindow, so only the parts looked at get decoded."""
+    tiled = kwargs.pop("tiled", True)
+    tile_cache = kwargs.pop("tile_cache", None)
+    if kwargs.pop("shared", False):
+        gfunc = sources.file_source(file, tiled, tile_cache)
+    else:
+        gfunc = file_gfunc(file, tiled, tile_cache)
+    return ImageWidget(parent, gfunc, gfunc.isize, **kwargs)
+
+def IWFromTiles(parent, path, **kwargs):
+    """Return an ImageWidget object showing the tile file PATH (as made
+    by build_tile_file) without opening the image it was built from.
+    Accepts the same keyword arguments as ImageWidget."""
+    gfunc = TilePyramid(None, tile_file=open_tile_file(path))
+    return ImageWidget(parent, gfunc, gfunc.isize, **kwargs)
 
 def IWFromImage(parent, img, **kwargs):
-    "Return an imageWidget object based on a PIL image passed in."
-    (ulx, uly, lrx, lry) = img.getbbox()
-    return ImageWidget(parent,
-                       GfuncImageWrapper(img)
-                       (lrx - ulx, lry - uly),
-                       **kwargs)
+    """Return an imageWidget object based on a PIL image passed in.
+    The image is served from a TilePyramid (backed by the TileFile
+    tile_file, if given) unless the keyword argument tiled is passed as
+    False, in which case a GfuncImageWrapper is used.  A TilePyramid
+    also takes anything with the size, mode and crop of a PIL image,
+    like a TiffWindow; a GfuncImageWrapper needs a real PIL image."""
+    gfunc = image_gfunc(img, kwargs.pop("tiled", True),
+                        kwargs.pop("tile_file", None))
+    return ImageWidget(parent, gfunc, img.size, **kwargs)
+
+def image_gfunc(img, tiled=True, tile_file=None):
+    "Return the gfunc IWFromImage would serve IMG with."
+    if tiled:
+        return TilePyramid(img, tile_file=tile_file)
+    if not isinstance(img, Image.Image):
+        raise TypeError, ("untiled images must be PIL images, not %s"
+                          % img.__class__.__name__)
+    return GfuncImageWrapper(img)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--build-tiles"]:
+        sys.exit(build_tiles_main(sys.argv[2:]))
+
     root = Tk()
     root.resizable(True, True)
 
+    ## An argument ending in .tiles is shown straight from the tile file.
+    file = sys.argv[1] if len(sys.argv) > 1 else "iw_test.tiff"
+    if file.endswith(".tiles"):
+        IWFrom = IWFromTiles
+    else:
+        IWFrom = IWFromFile
+
     # root.bind("<Configure>", lambda e, t="root": dbg_display_tag_and_size(t, e))
-    iw = IWFromFile(root, "iw_test.tiff", starting_ul = (0,0),
-                    starting_size = (200, 200), starting_zoom = 1.0,
-                    mouse_click_function = dbg_print_coords,
-#                    mouse_tracking_function = dbg_print_coords,
-                    maxsize_callback = lambda w,h,r=root: r.maxsize(w,h))
+    iw = IWFrom(root, file, starting_ul = (0,0),
+                starting_size = (200, 200), starting_zoom = 1.0,
+                mouse_click_function = dbg_print_coords,
+#                mouse_tracking_function = dbg_print_coords,
+                maxsize_callback = lambda w,h,r=root: r.maxsize(w,h))
     iw.grid(row=0,column=0, sticky=N+S+E+W)
     root.rowconfigure(0, weight=1)
     root.columnconfigure(0, weight=1)
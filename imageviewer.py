@@ -27,6 +27,9 @@
 
 from PyQt4 import QtCore, QtGui
 import os
+import math
+from collections import OrderedDict
+from xform import Affine
 
 class CoordXform1D:
     """Contain details of a transformation between 1-D coordinate frames.
@@ -39,13 +42,17 @@ class CoordXform1D:
         return (point + self.__from_offset) * self.__scale + self.__to_offset
 
 class QCoordXform:
-    """Like transformation, except its 2D and works on Qpoints."""
+    """Like CoordXform1D, except its 2D and works on QPoints (and
+    QPointFs).  The underlying xform.Affine is in .xform, for mapping
+    whole arrays of points at once."""
     def __init__(self, from1, to1, from2, to2):
-        self.__0xform = Transformation(from1.x(), to1.x(), from2.x(), to2.x())
-        self.__1xform = Transformation(from1.y(), to1.y(), from2.y(), to2.y())
+        self.xform = Affine.between((from1.x(), from1.y()), (to1.x(), to1.y()),
+                                    (from2.x(), from2.y()), (to2.x(), to2.y()))
     def transform(self, point):
-        return QPoint(self.__0xform.transform(point.x()),
-                      self.__1xform.transform(point.y()))
+        (x, y) = self.xform.point(point.x(), point.y())
+        if isinstance(point, QtCore.QPoint):
+            return QtCore.QPoint(int(round(x)), int(round(y)))
+        return QtCore.QPointF(x, y)
 
 class QScrollZoomArea(QtGui.QScrollArea):
     """Specialization of QScrollArea to include integrated zooming.
@@ -75,6 +82,7 @@ class QScrollZoomArea(QtGui.QScrollArea):
         if zoomPoint is None:
             zoomPoint = (hscroll.pageStep()/2, vscroll.pageStep()/2)
 
+        self.noteInteraction()
         self.scaleFactor *= factor
         self.widget().resize(self.scaleFactor * self.widget().sizeHint())
 
@@ -97,8 +105,15 @@ class QScrollZoomArea(QtGui.QScrollArea):
         scrollbar.setValue(scrollbar.value() - delta)
 
     # Default user interface bindings--google maps style
+    def noteInteraction(self):
+        """Tell the contained widget (if it cares) that the user is in the
+        middle of zooming or dragging it."""
+        if hasattr(self.widget(), "interacting"):
+            self.widget().interacting()
+
     def dragScroll(self, p):
         """Scroll the viewport by the given point (as a delta) in viewport coords."""
+        self.noteInteraction()
         self.adjustScrollBarForDrag(self.horizontalScrollBar(), p.x())
         self.adjustScrollBarForDrag(self.verticalScrollBar(), p.y())
 
@@ -124,15 +139,201 @@ class QScrollZoomArea(QtGui.QScrollArea):
         self.dragScroll(ev.pos() - self._lastMouseLocation)
         self._lastMouseLocation = ev.pos()
 
+class QScaledTileCache:
+    """Cache of pixmaps (or images), holding at most maxBytes of pixels
+    and dropping the least recently used pixmaps to make room."""
+    def __init__(self, maxBytes = 64 << 20):
+        self._maxBytes = maxBytes
+        self._bytes = 0
+        self._pixmaps = OrderedDict()   # Least recently used first
+
+    @staticmethod
+    def pixmapBytes(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, key):
+        """Return the pixmap stored under key (marking it used), or None."""
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is not None:
+            self._pixmaps[key] = pixmap
+        return pixmap
+
+    def insert(self, key, pixmap):
+        if key in self._pixmaps:
+            self._bytes -= self.pixmapBytes(self._pixmaps.pop(key))
+        self._pixmaps[key] = pixmap
+        self._bytes += self.pixmapBytes(pixmap)
+        while self._bytes > self._maxBytes and len(self._pixmaps) > 1:
+            (oldKey, oldPixmap) = self._pixmaps.popitem(last = False)
+            self._bytes -= self.pixmapBytes(oldPixmap)
+
+    def clear(self):
+        self._pixmaps.clear()
+        self._bytes = 0
+
+class QImageFile:
+    """Stand-in for a QImage of a picture in a file too big to decode
+    whole.  It's decoded a block at a time as parts of it are drawn;
+    blocks are blockSize pixels square, reduced by a power of two to
+    about the scale they're drawn at, and kept in a QScaledTileCache of
+    cacheBytes.  Blocks reduced by no more than 2**maxDecodeLevel are
+    decoded from the file (a clip of at most blockSize << maxDecodeLevel
+    pixels square); smaller ones are built by halving the four blocks
+    under them, so no decode is ever bigger than that however far out
+    the view is.  Only worth using on files whose QImageReader can
+    decode a clip rectangle, scaled, without decoding everything (see
+    canClip())."""
+    blockSize = 512
+    maxDecodeLevel = 2
+
+    def __init__(self, filename, cacheBytes = 64 << 20):
+        self.filename = filename
+        self._size = QtGui.QImageReader(filename).size()
+        self._blocks = QScaledTileCache(cacheBytes)
+
+    @staticmethod
+    def canClip(filename):
+        reader = QtGui.QImageReader(filename)
+        return (reader.canRead() and reader.size().isValid()
+                and reader.supportsOption(QtGui.QImageIOHandler.ClipRect)
+                and reader.supportsOption(QtGui.QImageIOHandler.ScaledSize))
+
+    def size(self):
+        return QtCore.QSize(self._size)
+
+    def isNull(self):
+        return not self._size.isValid()
+
+    def __nonzero__(self):
+        return not self.isNull()
+
+    def block(self, level, bx, by):
+        """Return block (bx, by) of the picture reduced by 2**level."""
+        key = (level, bx, by)
+        image = self._blocks.get(key)
+        if image is None:
+            if level > self.maxDecodeLevel:
+                image = self.builtBlock(level, bx, by)
+            else:
+                image = self.decodedBlock(level, bx, by)
+            self._blocks.insert(key, image)
+        return image
+
+    def blockRect(self, level, bx, by):
+        """Return the part of the picture (a QRect) block (bx, by) covers
+        at the given level, and the block's size (a QSize)."""
+        span = self.blockSize << level
+        clip = QtCore.QRect(bx * span, by * span, span, span).intersected(
+            QtCore.QRect(QtCore.QPoint(0, 0), self._size))
+        d = 1 << level
+        return (clip, QtCore.QSize((clip.width() + d - 1) >> level,
+                                   (clip.height() + d - 1) >> level))
+
+    def decodedBlock(self, level, bx, by):
+        (clip, size) = self.blockRect(level, bx, by)
+        reader = QtGui.QImageReader(self.filename)
+        reader.setClipRect(clip)
+        if level:
+            reader.setScaledSize(size)
+        return reader.read()
+
+    def builtBlock(self, level, bx, by):
+        (clip, size) = self.blockRect(level, bx, by)
+        image = QtGui.QImage(size, QtGui.QImage.Format_ARGB32_Premultiplied)
+        image.fill(0)
+        painter = QtGui.QPainter(image)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        half = self.blockSize // 2
+        for j in (0, 1):
+            for i in (0, 1):
+                (cx, cy) = (2 * bx + i, 2 * by + j)
+                if self.blockRect(level - 1, cx, cy)[0].isEmpty():
+                    continue
+                sub = self.block(level - 1, cx, cy)
+                if not sub.isNull():
+                    painter.drawImage(
+                        QtCore.QRectF(i * half, j * half,
+                                      sub.width() / 2.0, sub.height() / 2.0),
+                        sub)
+        painter.end()
+        return image
+
+    def draw(self, painter, target, source):
+        """Draw the source rectangle of the picture into the painter's
+        target rectangle (both QRectFs), like QPainter.drawImage."""
+        sx = source.width() / target.width()
+        sy = source.height() / target.height()
+        level = 0
+        while (2 << level) <= min(sx, sy):
+            level += 1
+        d = float(1 << level)
+        span = self.blockSize << level
+
+        # Draw the part of source in each block it crosses
+        inside = source.intersected(QtCore.QRectF(0, 0, self._size.width(),
+                                                  self._size.height()))
+        if inside.isEmpty():
+            return
+        for by in range(int(inside.top()) // span,
+                        (int(math.ceil(inside.bottom())) - 1) // span + 1):
+            for bx in range(int(inside.left()) // span,
+                            (int(math.ceil(inside.right())) - 1) // span + 1):
+                part = inside.intersected(
+                    QtCore.QRectF(bx * span, by * span, span, span))
+                if part.isEmpty():
+                    continue
+                image = self.block(level, bx, by)
+                if image.isNull():
+                    continue
+                painter.drawImage(
+                    QtCore.QRectF(
+                        target.left() + (part.left() - source.left()) / sx,
+                        target.top() + (part.top() - source.top()) / sy,
+                        part.width() / sx, part.height() / sy),
+                    image,
+                    QtCore.QRectF((part.left() - bx * span) / d,
+                                  (part.top() - by * span) / d,
+                                  part.width() / d, part.height() / d))
+
 class QLazyImage(QtGui.QWidget):
     """Class to contain an image, note resize events, and present
     (through paintEvent()) the image visually, but to only lazily compute
     the bitmaps to present.  This allows arbitrary resizing of images
-    without lots of excess computation."""
-    def __init__(self, image = None):
+    without lots of excess computation.
+    The widget is painted in tileSize squares, each scaled from the image
+    once for a given widget size and kept as a pixmap in a
+    QScaledTileCache of cacheBytes, so repainting what's been shown
+    before (as when scrolling back and forth) is just a copy.
+    While the user is zooming or dragging (see interacting()), tiles
+    that aren't cached are instead painted straight from the image with
+    an unsmoothed transform and not kept; once things have been still
+    for idleMsec, the widget is repainted with smooth, cached tiles.
+    The image may be a QImageFile rather than a QImage, in which case
+    only the parts of the picture being drawn are decoded."""
+    tileSize = 256
+    idleMsec = 200
+
+    def __init__(self, image = None, cacheBytes = 64 << 20):
         QtGui.QWidget.__init__(self)
+        self._tiles = QScaledTileCache(cacheBytes)
         self.setImage(image)
         self._painter = QtGui.QPainter()
+        self._interacting = False
+        self._idleTimer = QtCore.QTimer(self)
+        self._idleTimer.setSingleShot(True)
+        self._idleTimer.setInterval(self.idleMsec)
+        self._idleTimer.timeout.connect(self.settle)
+
+    def interacting(self):
+        """Note that a gesture (zoom or drag) is under way; paint quickly
+        until there's been none for idleMsec."""
+        self._interacting = True
+        self._idleTimer.start()
+
+    def settle(self):
+        """The gesture is over; repaint properly."""
+        self._interacting = False
+        self.update()
 
     def resizeEvent(self, event):
         self._size = event.size()
@@ -141,33 +342,100 @@ class QLazyImage(QtGui.QWidget):
     def paintEvent(self, event):
         if not self._image:
             return
-        r = QtCore.QRectF(event.region().boundingRect())
-        pf = (QtCore.QPointF(r.topLeft()), QtCore.QPointF(r.bottomRight()))
+        r = event.region().boundingRect()
+        T = self.tileSize
 
-        # What does this region look like in the original image?
-        orig_r = QtCore.QRectF(r.left() * self._scale[0],
-                               r.top() * self._scale[1],
-                               r.width() * self._scale[0],
-                               r.height() * self._scale[1])
-
-        # Paint the bitmap; scaling done by the painter
+        # Copy in the tiles under the region; the painter clips them to it
         self._painter.begin(self)
-        self._painter.drawImage(r, self._image, orig_r)
+        for ty in range(max(0, r.top()) // T, r.bottom() // T + 1):
+            for tx in range(max(0, r.left()) // T, r.right() // T + 1):
+                if self._interacting:
+                    pixmap = self._tiles.get(self.tileKey(tx, ty))
+                    if pixmap is None:
+                        # Scaling done by the painter, quick and rough
+                        rects = self.tileRects(tx, ty)
+                        if rects is not None:
+                            self.drawImage(self._painter, rects[0], rects[1])
+                        continue
+                else:
+                    pixmap = self.tile(tx, ty)
+                if pixmap is not None:
+                    self._painter.drawPixmap(tx * T, ty * T, pixmap)
         self._painter.end()
 
+    def tileKey(self, tx, ty):
+        return (self._size.width(), self._size.height(), tx, ty)
+
+    def tileRects(self, tx, ty):
+        """Return (r, orig_r): the rectangle tile (tx, ty) covers in the
+        widget and in the image, or None if the tile is outside the widget."""
+        T = self.tileSize
+        r = QtCore.QRectF(tx * T, ty * T,
+                          min(T, self._size.width() - tx * T),
+                          min(T, self._size.height() - ty * T))
+        if r.width() <= 0 or r.height() <= 0:
+            return None
+
+        # What does this tile look like in the original image?
+        (x0, y0, x1, y1) = self._imageXform.rect((r.left(), r.top(),
+                                                  r.right(), r.bottom()))
+        return (r, QtCore.QRectF(x0, y0, x1 - x0, y1 - y0))
+
+    def tile(self, tx, ty):
+        """Return the pixmap of tile (tx, ty) of the widget at its current
+        size, scaling it from the image if it isn't cached (None if the
+        tile is outside the widget)."""
+        key = self.tileKey(tx, ty)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            return pixmap
+
+        rects = self.tileRects(tx, ty)
+        if rects is None:
+            return None
+        (r, orig_r) = rects
+        pixmap = QtGui.QPixmap(int(r.width()), int(r.height()))
+        pixmap.fill(QtCore.Qt.transparent)
+        painter = QtGui.QPainter(pixmap)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        self.drawImage(painter, QtCore.QRectF(0, 0, r.width(), r.height()),
+                       orig_r)
+        painter.end()
+        self._tiles.insert(key, pixmap)
+        return pixmap
+
+    def drawImage(self, painter, target, source):
+        """Draw the source rectangle of the image into target."""
+        if isinstance(self._image, QImageFile):
+            self._image.draw(painter, target, source)
+        else:
+            painter.drawImage(target, self._image, source)
+
     def sizeHint(self):
         if self._image:
-            return self._image.size()
+            return self._naturalSize
         else:
             return QtCore.QSize(1,1)
 
-    def setImage(self, image):
+    def setImage(self, image, naturalSize = None):
+        """Show image.  naturalSize is the size of the picture it depicts,
+        if image is a reduced copy (e.g. a preview while loading)."""
         self._image = image
+        self._tiles.clear()
         if image:
-            self._size = image.size()
+            self._naturalSize = naturalSize or image.size()
+            self._size = self._naturalSize
         else:
             self._size = QtCore.QSize(1,1)
-            self.setScale()
+        self.setScale()
+
+    def refineImage(self, image):
+        """Replace the image by a more detailed copy of the same picture,
+        leaving the widget's size (and so any zoom) alone."""
+        self._image = image
+        self._tiles.clear()
+        self.setScale()
+        self.update()
 
     def setScale(self):
         if self._image:
@@ -177,8 +445,61 @@ class QLazyImage(QtGui.QWidget):
                             / self._size.height()))
         else:
             self._scale = (1.0, 1.0)
+        # Widget coordinates to image coordinates
+        self._imageXform = Affine.scaling(*self._scale)
+
+class QImageLoader(QtCore.QThread):
+    """Thread to decode an image file with QImageReader, off the GUI thread.
+    If the image is bigger than previewSize, a copy scaled down to fit it
+    is decoded first and sent out through preview(image, fullSize); the
+    full image follows through loaded(image).  progress(percent) reports
+    how far along things are, and failed(message) that the file couldn't
+    be read."""
+    previewSize = QtCore.QSize(1024, 1024)
+
+    preview = QtCore.pyqtSignal(QtGui.QImage, QtCore.QSize)
+    loaded = QtCore.pyqtSignal(QtGui.QImage)
+    progress = QtCore.pyqtSignal(int)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, filename, parent = None):
+        QtCore.QThread.__init__(self, parent)
+        self.filename = filename
+
+    def run(self):
+        self.progress.emit(0)
+        reader = QtGui.QImageReader(self.filename)
+        fullSize = reader.size()
+        if not reader.canRead():
+            self.failed.emit(reader.errorString())
+            return
+        self.progress.emit(10)
+
+        if (fullSize.isValid()
+            and (fullSize.width() > self.previewSize.width()
+                 or fullSize.height() > self.previewSize.height())):
+            scaledSize = QtCore.QSize(fullSize)
+            scaledSize.scale(self.previewSize, QtCore.Qt.KeepAspectRatio)
+            reader.setScaledSize(scaledSize)
+            image = reader.read()
+            if not image.isNull():
+                self.preview.emit(image, fullSize)
+            self.progress.emit(40)
+            # A reader only goes through its file once
+            reader = QtGui.QImageReader(self.filename)
+
+        image = reader.read()
+        if image.isNull():
+            self.failed.emit(reader.errorString())
+            return
+        self.progress.emit(100)
+        self.loaded.emit(image)
 
 class ImageViewer(QtGui.QMainWindow):
+    # Pictures of more pixels than this are shown from a QImageFile
+    # when their format allows it, rather than decoded whole
+    hugePixels = 64 << 20
+
     def __init__(self, image_file = None):
         super(ImageViewer, self).__init__()
 
@@ -198,19 +519,77 @@ class ImageViewer(QtGui.QMainWindow):
         self.createActions()
         self.createMenus()
 
+        self._loader = None
+        self._loadProgress = QtGui.QProgressBar()
+        self._loadProgress.setRange(0, 100)
+        self._loadProgress.setMaximumWidth(150)
+        self._loadProgress.hide()
+        self.statusBar().addPermanentWidget(self._loadProgress)
+
         self.setWindowTitle("Image Viewer")
         self.resize(500, 400)
 
         if image_file: self.__open(image_file)
 
     def __open(self, filename):
-        image = QtGui.QImage(filename)
-        if image.isNull():
-            QtGui.QMessageBox.information(self, "Image Viewer",
-                    "Cannot load %s." % filename)
+        self._filename = filename
+        if QImageFile.canClip(filename):
+            image = QImageFile(filename)
+            if image.size().width() * image.size().height() > self.hugePixels:
+                self.__loaderDone()
+                self.__show(image)
+                return
+
+        # Decoding happens on a loader thread; the __loader* slots below
+        # take it from there.  Anything an earlier loader still sends
+        # is ignored.
+        self._previewShown = False
+        self._loader = QImageLoader(filename, self)
+        self._loader.preview.connect(self.__loaderPreview)
+        self._loader.loaded.connect(self.__loaderLoaded)
+        self._loader.progress.connect(self.__loaderProgress)
+        self._loader.failed.connect(self.__loaderFailed)
+        self._loader.finished.connect(self._loader.deleteLater)
+        self._loadProgress.setValue(0)
+        self._loadProgress.show()
+        self.statusBar().showMessage("Loading %s..." % filename)
+        self._loader.start()
+
+    def __loaderPreview(self, image, fullSize):
+        if self.sender() is not self._loader:
+            return
+        self.__show(image, fullSize)
+        self._previewShown = True
+
+    def __loaderLoaded(self, image):
+        if self.sender() is not self._loader:
+            return
+        if self._previewShown:
+            # Preview is up; keep the layout and zoom
+            self.imageWidget.refineImage(image)
+        else:
+            self.__show(image)
+        self.__loaderDone()
+
+    def __loaderProgress(self, percent):
+        if self.sender() is not self._loader:
             return
+        self._loadProgress.setValue(percent)
+
+    def __loaderFailed(self, message):
+        if self.sender() is not self._loader:
+            return
+        self.__loaderDone()
+        QtGui.QMessageBox.information(self, "Image Viewer",
+                "Cannot load %s: %s" % (self._filename, message))
+
+    def __loaderDone(self):
+        self._loader = None
+        self._loadProgress.hide()
+        self.statusBar().clearMessage()
 
-        self.imageWidget.setImage(image)
+    def __show(self, image, naturalSize = None):
+        self.imageWidget.setImage(image, naturalSize)
         self.scaleFactor = 1.0
 
         self.printAct.setEnabled(True)
@@ -223,7 +602,7 @@ class ImageViewer(QtGui.QMainWindow):
     def open(self):
         fileName = QtGui.QFileDialog.getOpenFileName(self, "Open File",
                 QtCore.QDir.currentPath())
-        if fileName: self.__open(filename)
+        if fileName: self.__open(fileName)
 
     def print_(self):
         dialog = QtGui.QPrintDialog(self.printer, self)
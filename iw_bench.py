@@ -0,0 +1,513 @@
+#!/usr/bin/python
+
+## Interaction benchmarks for image_widget.ImageWidget.
+##
+## Each run replays a trace of user input (drags, wheel clicks,
+## scrollbar requests and window resizes) against a fresh widget and
+## reports how long the view took to catch up after each event, how many
+## tiles the gfunc rendered per second, and the peak resident size of the
+## process.  Runs go under the X display in DISPLAY, or under a private
+## Xvfb server if there isn't one.  With --headless there's no Tk at all:
+## the views a trace passes through are rendered straight from the gfunc.
+##
+## A trace is a list of [time, name, args...] with time in seconds from
+## the start; the names are
+##	press x y / motion x y / release x y	mouse button 1 (canvas coords)
+##	wheel count x y				scrollWheel_action
+##	xview args... / yview args...		scrollbar commands
+##	resize width height			resize_action
+## Traces can be recorded from a live widget with --record and replayed
+## with --trace; otherwise the built in drag, wheel, scroll and resize
+## traces are used.
+##
+## Sources are image files or "synthetic:WIDTHxHEIGHT", an image of noise
+## that's generated as it's cropped, so any size costs nothing to open.
+
+import sys
+import os
+import time
+import json
+import resource
+import subprocess
+import threading
+import traceback
+import Queue
+import multiprocessing
+import optparse
+from PIL import Image
+import image_widget
+from image_widget import (ImageWidget, ImageCache, TilePyramid,
+                          GfuncImageWrapper, TiffWindow, ladder_zoom,
+                          difference)
+
+## How long (s) to let a trace's last event settle before the run ends
+SETTLE_TIME = 0.5
+
+DefaultSources = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "iw_test.tiff"),
+                  "synthetic:65536x65536"]
+
+## Sources
+
+class SyntheticImage:
+    "A noise image of SIZE whose pixels are made up as they're cropped."
+    def __init__(self, size, mode="RGB"):
+        self.size = size
+        self.mode = mode
+
+    def crop(self, box):
+        size = (box[2] - box[0], box[3] - box[1])
+        return Image.effect_noise(size, 64).convert(self.mode)
+
+def source_image(source):
+    "Return a PIL image (or duck image) for the source named SOURCE."
+    if source.startswith("synthetic:"):
+        (w, h) = source[len("synthetic:"):].split("x")
+        return SyntheticImage((int(w), int(h)))
+    img = Image.open(source)
+    if img.format == "TIFF":
+        try:
+            img = TiffWindow(source)
+        except TiffWindow.Unsupported:
+            pass
+    return img
+
+class CountingGfunc:
+    "A gfunc passing calls on to GFUNC, counting the renders it does."
+    def __init__(self, gfunc):
+        self.gfunc = gfunc
+        self.renders = 0
+        self.lock = threading.Lock()
+        ## Only offer region() if the wrapped gfunc does (see ImageWidget)
+        if hasattr(gfunc, "region"):
+            self.region = self.counted_region
+        self.tiled = getattr(gfunc, "tiled", False)
+
+    def count(self):
+        with self.lock:
+            self.renders += 1
+
+    def counted_region(self, zoom, xint, yint):
+        self.count()
+        return self.gfunc.region(zoom, xint, yint)
+
+    def __call__(self, zoom, xint, yint):
+        self.count()
+        return self.gfunc(zoom, xint, yint)
+
+def source_gfunc(source, wrapper=False):
+    """Return (gfunc, size) for SOURCE, as IWFromImage would build them.
+    A GfuncImageWrapper (WRAPPER) needs the whole image decoded, so
+    can't be used on synthetic sources."""
+    if wrapper:
+        if source.startswith("synthetic:"):
+            raise ValueError, "--wrapper can't use %s" % (source,)
+        img = Image.open(source)
+        img.load()
+        return (GfuncImageWrapper(img), img.size)
+    img = source_image(source)
+    return (TilePyramid(img), img.size)
+
+## Traces
+
+def drag_trace(view):
+    "Drag the image across and back, as a 120Hz stream of motion events."
+    (x, y) = (view[0] // 2, view[1] // 2)
+    trace = [[0.0, "press", x, y]]
+    t = 0.0
+    for (dx, dy) in [(-8, -6)] * 60 + [(8, 6)] * 60:
+        t += 1.0 / 120
+        (x, y) = (x + dx, y + dy)
+        trace.append([t, "motion", x, y])
+    trace.append([t + 0.01, "release", x, y])
+    return trace
+
+def wheel_trace(view):
+    "Zoom in a few clicks, pause, and zoom back out past where we started."
+    (x, y) = (view[0] // 2, view[1] // 2)
+    trace = []
+    t = 0.0
+    for count in [1] * 5 + [None] + [-1] * 8 + [None]:
+        if count is None:
+            t += 0.4
+        else:
+            t += 0.05
+            trace.append([t, "wheel", count, x, y])
+    return trace
+
+def scroll_trace(view):
+    "Page and jump around with the scrollbars."
+    trace = []
+    t = 0.0
+    for args in ([["xview", "scroll", 1, "pages"]] * 4
+                 + [["yview", "scroll", 1, "pages"]] * 4
+                 + [["xview", "scroll", 10, "units"]] * 10
+                 + [["xview", "moveto", "0.5"], ["yview", "moveto", "0.5"],
+                    ["xview", "moveto", "0.0"], ["yview", "moveto", "0.0"]]):
+        t += 0.1
+        trace.append([t] + args)
+    return trace
+
+def resize_trace(view):
+    "Grow the window from half size to full size, then shrink it again."
+    trace = []
+    t = 0.0
+    steps = range(view[0] // 2, view[0] + 1, 20)
+    for w in steps + steps[::-1]:
+        t += 1.0 / 60
+        trace.append([t, "resize", w, w * view[1] // view[0]])
+    return trace
+
+Traces = [("drag", drag_trace), ("wheel", wheel_trace),
+          ("scroll", scroll_trace), ("resize", resize_trace)]
+
+class Event:
+    "Stands in for the Tk event objects passed to the ev_ handlers."
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+def dispatch(iw, step):
+    "Apply the trace step STEP to the widget IW."
+    name = step[1]
+    args = step[2:]
+    if name == "press":
+        iw.ev_Button_1(Event(*args))
+    elif name == "motion":
+        iw.ev_Motion(Event(*args))
+    elif name == "release":
+        iw.ev_ButtonRelease_1(Event(*args))
+    elif name == "wheel":
+        iw.scrollWheel_action(args[0], args[1:3])
+    elif name == "xview":
+        iw.xview_action(*args)
+    elif name == "yview":
+        iw.yview_action(*args)
+    elif name == "resize":
+        iw.resize_action(tuple(args))
+    else:
+        raise ValueError, "unknown trace step %r" % (name,)
+
+## Running
+
+def percentile(values, p):
+    "Return the Pth percentile of the sorted list VALUES."
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def peak_rss():
+    "Return the peak resident size of this process, in megabytes."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def result(source, trace_name, latencies, renders, seconds):
+    latencies = sorted(latencies)
+    r = {"source": source, "trace": trace_name,
+         "events": len(latencies),
+         "p50_ms": percentile(latencies, 50) * 1000,
+         "p90_ms": percentile(latencies, 90) * 1000,
+         "p99_ms": percentile(latencies, 99) * 1000,
+         "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+         "renders": renders,
+         "renders_per_s": renders / max(seconds, 1e-6),
+         "peak_rss_mb": peak_rss()}
+    if image_widget.timings.enabled:
+        r["timings"] = image_widget.timings.summary()
+    return r
+
+def caught_up(iw):
+    "Return True if IW has drawn everything its last event asked for."
+    return iw.evv_dragFlushId is None and not iw.overscan_pending
+
+def run_widget(source, trace_name, trace, options):
+    """Replay TRACE against a widget showing SOURCE, keeping to the
+    trace's timing, and return the run's result."""
+    from Tkinter import Tk, N, S, E, W
+    (gfunc, size) = source_gfunc(source, options.wrapper)
+    gfunc = CountingGfunc(gfunc)
+    if options.timings:
+        image_widget.timings.enable()
+    root = Tk()
+    iw = ImageWidget(root, gfunc, size, starting_size=options.view,
+                     prefetch_threads=options.threads)
+    iw.grid(row=0, column=0, sticky=N+S+E+W)
+    root.update()
+    gfunc.renders = 0
+
+    ## An event's latency runs from when it's handed to the widget until
+    ## the view (and guard band) it calls for has been drawn; coalesced
+    ## drags are only drawn at the next frame, and that wait counts.
+    latencies = []
+    start = time.time()
+    for step in trace:
+        while time.time() - start < step[0]:
+            root.update()
+        t = time.time()
+        dispatch(iw, step)
+        root.update_idletasks()
+        while not caught_up(iw):
+            root.update()
+        latencies.append(time.time() - t)
+    end = time.time() + SETTLE_TIME
+    while time.time() < end:
+        root.update()
+    r = result(source, trace_name, latencies, gfunc.renders,
+               time.time() - start)
+    root.destroy()
+    return r
+
+def trace_views(trace, isize, view):
+    """Yield the (zoom, xint, yint) views a widget of size VIEW over an
+    image of ISIZE would pass through following TRACE."""
+    step = 0
+    (xint, yint) = ([0, view[0]], [0, view[1]])
+    ## As the widget's first resize_action would
+    ImageWidget.resize_view_axis(xint, view[0], isize[0])
+    ImageWidget.resize_view_axis(yint, view[1], isize[1])
+    last = None
+    for s in trace:
+        (name, args) = (s[1], s[2:])
+        zoom = ladder_zoom(step)
+        if name == "press":
+            last = tuple(args)
+            continue
+        elif name == "release":
+            last = None
+            continue
+        elif name == "motion":
+            if last is None:
+                continue
+            diff = difference(tuple(args), last)
+            last = tuple(args)
+            ImageWidget.general_scroll_action(xint, isize[0] * zoom, diff[0])
+            ImageWidget.general_scroll_action(yint, isize[1] * zoom, diff[1])
+        elif name == "wheel":
+            newZoom = ladder_zoom(step + args[0])
+            size = (xint[1] - xint[0], yint[1] - yint[0])
+            if isize[0] * zoom < size[0] or isize[1] * zoom < size[1]:
+                continue
+            loc = (int((args[1] + xint[0]) * newZoom / zoom),
+                   int((args[2] + yint[0]) * newZoom / zoom))
+            xi = [loc[0] - args[1], loc[0] - args[1] + size[0]]
+            yi = [loc[1] - args[2], loc[1] - args[2] + size[1]]
+            if (xi[0] < 0 or xi[1] > newZoom * isize[0]
+                or yi[0] < 0 or yi[1] > newZoom * isize[1]):
+                continue
+            (step, xint, yint) = (step + args[0], xi, yi)
+        elif name in ("xview", "yview"):
+            (axis, length) = ((xint, isize[0]) if name == "xview"
+                              else (yint, isize[1]))
+            ImageWidget.starview_action(axis, int(length * zoom), *args)
+        elif name == "resize":
+            ImageWidget.resize_view_axis(xint, args[0], isize[0] * zoom)
+            ImageWidget.resize_view_axis(yint, args[1], isize[1] * zoom)
+        yield (ladder_zoom(step), list(xint), list(yint))
+
+def run_headless(source, trace_name, trace, options):
+    """Render the views TRACE passes through over SOURCE straight from the
+    gfunc, view tile by view tile as the widget would (keeping rendered
+    tiles in a cache of the same size), and return the run's result."""
+    (gfunc, size) = source_gfunc(source, options.wrapper)
+    T = options.tile_size
+    if options.timings:
+        image_widget.timings.enable()
+    tiles = ImageCache(64 << 20)
+    (latencies, renders) = ([], 0)
+    start = time.time()
+    for (zoom, xint, yint) in trace_views(trace, size, options.view):
+        t = time.time()
+        zsize = (int(size[0] * zoom), int(size[1] * zoom))
+        for ty in range(max(0, yint[0]) // T, (min(yint[1], zsize[1]) - 1) // T + 1):
+            for tx in range(max(0, xint[0]) // T, (min(xint[1], zsize[0]) - 1) // T + 1):
+                if (zoom, tx, ty) in tiles:
+                    continue
+                tiles[(zoom, tx, ty)] = gfunc.region(
+                    zoom, [tx * T, min((tx + 1) * T, zsize[0])],
+                    [ty * T, min((ty + 1) * T, zsize[1])])
+                renders += 1
+        latencies.append(time.time() - t)
+    return result(source, trace_name, latencies, renders, time.time() - start)
+
+def run_child(results, run, args):
+    try:
+        results.put((True, run(*args)))
+    except Exception:
+        results.put((False, traceback.format_exc()))
+
+def run_isolated(run, *args):
+    """Call RUN(*ARGS) in a process of its own, so that each run starts
+    with cold caches and its own peak RSS, and return what it returns.
+    Raises RuntimeError if the run raises or its process dies."""
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_child, args=(results, run, args))
+    p.start()
+    while True:
+        try:
+            (ok, r) = results.get(timeout=1.0)
+            break
+        except Queue.Empty:
+            if not p.is_alive():
+                ## One last look, in case it finished just now
+                try:
+                    (ok, r) = results.get(timeout=1.0)
+                    break
+                except Queue.Empty:
+                    p.join()
+                    raise RuntimeError, ("benchmark process exited with code %s"
+                                         % p.exitcode)
+    p.join()
+    if not ok:
+        raise RuntimeError, "benchmark run failed:\n" + r
+    if p.exitcode:
+        raise RuntimeError, ("benchmark process exited with code %s"
+                             % p.exitcode)
+    return r
+
+## X display
+
+def start_xvfb(size):
+    """Start an Xvfb server big enough for SIZE on a free display, point
+    DISPLAY at it, and return its process."""
+    n = 99
+    while os.path.exists("/tmp/.X%d-lock" % n):
+        n += 1
+    devnull = open(os.devnull, "w")
+    proc = subprocess.Popen(["Xvfb", ":%d" % n, "-screen", "0",
+                             "%dx%dx24" % (size[0] + 200, size[1] + 200),
+                             "-nolisten", "tcp"],
+                            stdout=devnull, stderr=devnull)
+    deadline = time.time() + 10
+    while not os.path.exists("/tmp/.X11-unix/X%d" % n):
+        if proc.poll() is not None or time.time() > deadline:
+            raise OSError, "Xvfb didn't start on :%d" % n
+        time.sleep(0.05)
+    os.environ["DISPLAY"] = ":%d" % n
+    return proc
+
+## Recording
+
+def record(source, path, view):
+    """Show SOURCE in a widget and write the user's drags, wheel clicks,
+    scrollbar requests and resizes to PATH as a trace when it's closed."""
+    from Tkinter import Tk, N, S, E, W
+    (gfunc, size) = source_gfunc(source)
+    root = Tk()
+    iw = ImageWidget(root, gfunc, size, starting_size=view)
+    iw.grid(row=0, column=0, sticky=N+S+E+W)
+    root.rowconfigure(0, weight=1)
+    root.columnconfigure(0, weight=1)
+    trace = []
+    start = time.time()
+
+    def note(name, *args):
+        trace.append([round(time.time() - start, 4), name] + list(args))
+    iw.canvas.bind("<Button-1>", lambda e: note("press", e.x, e.y), "+")
+    iw.canvas.bind("<Motion>", lambda e: iw.evv_buttonDown
+                                         and note("motion", e.x, e.y), "+")
+    iw.canvas.bind("<ButtonRelease-1>", lambda e: note("release", e.x, e.y), "+")
+    iw.canvas.bind("<MouseWheel>",
+                   lambda e: note("wheel", e.delta, e.x, e.y), "+")
+    iw.canvas.bind("<Configure>",
+                   lambda e: note("resize", e.width, e.height), "+")
+
+    def scroller(name, action):
+        def scroll(*args):
+            note(name, *args)
+            action(*args)
+        return scroll
+    iw.hscroll["command"] = scroller("xview", iw.xview_action)
+    iw.vscroll["command"] = scroller("yview", iw.yview_action)
+    root.mainloop()
+
+    f = open(path, "w")
+    try:
+        json.dump(trace, f)
+    finally:
+        f.close()
+    print "%s: %d events" % (path, len(trace))
+
+## Main
+
+def report(results):
+    print "%-28s %-8s %6s %8s %8s %8s %8s %8s %10s %8s" % (
+        "source", "trace", "events", "p50 ms", "p90 ms", "p99 ms", "max ms",
+        "renders", "renders/s", "RSS MB")
+    for r in results:
+        print "%-28s %-8s %6d %8.1f %8.1f %8.1f %8.1f %8d %10.1f %8.1f" % (
+            os.path.basename(r["source"])[-28:], r["trace"], r["events"],
+            r["p50_ms"], r["p90_ms"], r["p99_ms"], r["max_ms"],
+            r["renders"], r["renders_per_s"], r["peak_rss_mb"])
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [SOURCE...]")
+    parser.add_option("--headless", action="store_true", default=False,
+                      help="render from the gfunc alone, without Tk")
+    parser.add_option("--trace", action="append", default=[],
+                      help="replay this recorded trace file (repeatable)")
+    parser.add_option("--record", metavar="FILE",
+                      help="record a trace from the first source to FILE")
+    parser.add_option("--wrapper", action="store_true", default=False,
+                      help="use a GfuncImageWrapper instead of a TilePyramid")
+    parser.add_option("--view", default="800x600",
+                      help="view size, WIDTHxHEIGHT (default 800x600)")
+    parser.add_option("--threads", type="int", default=2,
+                      help="prefetch threads (default 2)")
+    parser.add_option("--tile-size", type="int", default=256,
+                      help="view tile size for --headless (default 256)")
+    parser.add_option("--timings", action="store_true", default=False,
+                      help="add image_widget's timing summary to the results")
+    parser.add_option("--json", metavar="FILE",
+                      help="also write the results to FILE as JSON")
+    (options, sources) = parser.parse_args(argv)
+    options.view = tuple(int(n) for n in options.view.split("x"))
+    if options.wrapper:
+        if not sources:
+            sources = [s for s in DefaultSources
+                       if not s.startswith("synthetic:")]
+        elif [s for s in sources if s.startswith("synthetic:")]:
+            parser.error("--wrapper needs image files, not synthetic sources")
+    sources = sources or DefaultSources
+
+    if options.trace:
+        traces = []
+        for path in options.trace:
+            f = open(path)
+            try:
+                traces.append((os.path.basename(path), json.load(f)))
+            finally:
+                f.close()
+    else:
+        traces = [(name, make(options.view)) for (name, make) in Traces]
+
+    xvfb = None
+    if not options.headless and not os.environ.get("DISPLAY"):
+        try:
+            xvfb = start_xvfb(options.view)
+        except OSError, e:
+            print >> sys.stderr, "No display and no Xvfb (%s); try --headless" % e
+            return 1
+    try:
+        if options.record:
+            record(sources[0], options.record, options.view)
+            return 0
+        run = run_headless if options.headless else run_widget
+        results = []
+        for source in sources:
+            for (name, trace) in traces:
+                results.append(run_isolated(run, source, name, trace, options))
+    finally:
+        if xvfb:
+            xvfb.terminate()
+            xvfb.wait()
+
+    report(results)
+    if options.json:
+        f = open(options.json, "w")
+        try:
+            json.dump(results, f, indent=1)
+        finally:
+            f.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
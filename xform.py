@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+## Affine transformations between 2-D coordinate frames (image pixels,
+## zoomed image pixels, canvas or widget pixels, scroll bar fractions),
+## shared by image_widget.py and imageviewer.py.
+##
+## An Affine maps (x, y) to (a*x + b*y + c, d*x + e*y + f).  They
+## compose (t * u is u, then t) and invert, and apply to single points,
+## to boxes (x0, y0, x1, y1), and to whole arrays of either at once:
+## given NumPy, points() and rects() take an array whose last axis is
+## the point or box and do the lot in a few array operations.  Without
+## NumPy they take sequences and return lists.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Affine:
+    def __init__(self, a=1.0, b=0.0, c=0.0, d=0.0, e=1.0, f=0.0):
+        "Make the transformation (x, y) -> (a*x + b*y + c, d*x + e*y + f)."
+        (self.a, self.b, self.c) = (float(a), float(b), float(c))
+        (self.d, self.e, self.f) = (float(d), float(e), float(f))
+
+    @staticmethod
+    def scaling(sx, sy=None):
+        "Scale by SX along x and SY (default SX) along y."
+        if sy is None:
+            sy = sx
+        return Affine(sx, 0, 0, 0, sy, 0)
+
+    @staticmethod
+    def translation(dx, dy):
+        return Affine(1, 0, dx, 0, 1, dy)
+
+    @staticmethod
+    def between(from1, to1, from2, to2):
+        """Return the scaling and translation taking point FROM1 to TO1 and
+        FROM2 to TO2 (each an (x, y) pair); along each axis, like a
+        mapping from the range [from1, from2] to [to1, to2]."""
+        sx = (to2[0] - to1[0]) / (1.0 * (from2[0] - from1[0]))
+        sy = (to2[1] - to1[1]) / (1.0 * (from2[1] - from1[1]))
+        return Affine(sx, 0, to1[0] - from1[0] * sx,
+                      0, sy, to1[1] - from1[1] * sy)
+
+    def __mul__(self, other):
+        "Return the transformation doing OTHER, then this one."
+        return Affine(self.a * other.a + self.b * other.d,
+                      self.a * other.b + self.b * other.e,
+                      self.a * other.c + self.b * other.f + self.c,
+                      self.d * other.a + self.e * other.d,
+                      self.d * other.b + self.e * other.e,
+                      self.d * other.c + self.e * other.f + self.f)
+
+    def then(self, other):
+        "Return the transformation doing this one, then OTHER."
+        return other * self
+
+    def inverse(self):
+        det = self.a * self.e - self.b * self.d
+        if det == 0:
+            raise ValueError, "singular transformation %r" % (self,)
+        (a, b, d, e) = (self.e / det, -self.b / det, -self.d / det, self.a / det)
+        return Affine(a, b, -(a * self.c + b * self.f),
+                      d, e, -(d * self.c + e * self.f))
+
+    def is_axis_aligned(self):
+        "Does this take boxes to boxes (no rotation or shear)?"
+        return self.b == 0 and self.d == 0
+
+    def point(self, x, y):
+        return (self.a * x + self.b * y + self.c,
+                self.d * x + self.e * y + self.f)
+
+    def rect(self, box):
+        """Return the bounding box (x0, y0, x1, y1) of the transformed
+        BOX (x0, y0, x1, y1)."""
+        if self.is_axis_aligned():
+            (x0, y0) = self.point(box[0], box[1])
+            (x1, y1) = self.point(box[2], box[3])
+        else:
+            corners = [self.point(box[i], box[j])
+                       for (i, j) in ((0, 1), (2, 1), (0, 3), (2, 3))]
+            (x0, y0) = (min(p[0] for p in corners), min(p[1] for p in corners))
+            (x1, y1) = (max(p[0] for p in corners), max(p[1] for p in corners))
+        return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    def points(self, points):
+        """Transform POINTS, an array of shape (..., 2) (or any sequence of
+        (x, y) pairs without NumPy), returning the same shape."""
+        if numpy is None:
+            return [self.point(x, y) for (x, y) in points]
+        p = numpy.asarray(points, dtype=float)
+        (x, y) = (p[..., 0], p[..., 1])
+        return numpy.stack((self.a * x + self.b * y + self.c,
+                            self.d * x + self.e * y + self.f), axis=-1)
+
+    def rects(self, boxes):
+        """rect() for each of BOXES, an array of shape (..., 4) (or any
+        sequence of boxes without NumPy), returning the same shape."""
+        if numpy is None:
+            return [self.rect(box) for box in boxes]
+        r = numpy.asarray(boxes, dtype=float)
+        xs = r[..., [0, 2, 0, 2]]
+        ys = r[..., [1, 1, 3, 3]]
+        tx = self.a * xs + self.b * ys + self.c
+        ty = self.d * xs + self.e * ys + self.f
+        return numpy.stack((tx.min(axis=-1), ty.min(axis=-1),
+                            tx.max(axis=-1), ty.max(axis=-1)), axis=-1)
+
+    def __eq__(self, other):
+        return (isinstance(other, Affine)
+                and (self.a, self.b, self.c, self.d, self.e, self.f)
+                    == (other.a, other.b, other.c, other.d, other.e, other.f))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Affine(%g, %g, %g, %g, %g, %g)" % (self.a, self.b, self.c,
+                                                  self.d, self.e, self.f)
+
+IDENTITY = Affine()